@@ -6,12 +6,22 @@ them into a sqlite database.
 
 import sys
 import time
+import queue
 import random
 import logging
 import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from aslite.arxiv import get_response, parse_response
-from aslite.db import get_papers_db, get_metas_db
+from aslite.db import get_ingest_db
+
+def timed_parse(response, parser):
+    """ parses an api response, also returning how long it took """
+    t0 = time.time()
+    papers = parse_response(response, parser)
+    return papers, time.time() - t0
 
 if __name__ == '__main__':
 
@@ -21,6 +31,11 @@ if __name__ == '__main__':
     parser.add_argument('-n', '--num', type=int, default=100, help='up to how many papers to fetch')
     parser.add_argument('-s', '--start', type=int, default=0, help='start at what index')
     parser.add_argument('-b', '--break-after', type=int, default=3, help='how many 0 new papers in a row would cause us to stop early? or 0 to disable.')
+    parser.add_argument('-u', '--api-url', type=str, default=None, help='url of the arxiv api, e.g. of a local fake_arxiv.py for testing')
+    parser.add_argument('-p', '--pipeline', type=int, default=0, help='if set to 1, fetch the next pages while parsing and storing the previous ones')
+    parser.add_argument('--parser', type=str, default='etree', choices=['etree', 'feedparser'], help='how to parse the api responses, see check_parser.py')
+    parser.add_argument('--prefetch', type=int, default=2, help='in --pipeline mode, up to how many pages to fetch ahead of the one being stored')
+    parser.add_argument('--politeness', type=float, default=1.0, help='scales the sleeps between api requests, 0 only makes sense against a local fake_arxiv.py')
     args = parser.parse_args()
     print(args)
     """
@@ -32,29 +47,43 @@ if __name__ == '__main__':
     # query string of papers to look for
     q = 'cat:cs.CV+OR+cat:cs.LG+OR+cat:cs.CL+OR+cat:cs.AI+OR+cat:cs.NE+OR+cat:cs.RO'
 
-    pdb = get_papers_db(flag='c')
-    mdb = get_metas_db(flag='c')
-    prevn = len(pdb)
+    # all the papers of a page are stored in one transaction
+    idb = get_ingest_db()
+    prevn = len(idb)
 
-    def store(p):
-        pdb[p['_id']] = p
-        mdb[p['_id']] = {'_time': p['_time']}
+    # seconds spent in each stage, for the throughput stats at the end
+    stage_time = {'fetch': 0.0, 'parse': 0.0, 'store': 0.0}
 
-    # fetch the latest papers
-    total_updated = 0
-    zero_updates_in_a_row = 0
-    for k in range(args.start, args.start + args.num, 100):
-        logging.info('querying arxiv api for query %s at start_index %d' % (q, k))
+    # politeness towards the arxiv api: one request at a time, and a few seconds between
+    # any two of them, no matter which part of the pipeline is asking
+    api_lock = threading.Lock()
+    def fetch(k):
+        with api_lock:
+            logging.info('querying arxiv api for query %s at start_index %d' % (q, k))
+            t0 = time.time()
+            try:
+                resp = get_response(search_query=q, start_index=k, api_url=args.api_url)
+            except Exception:
+                time.sleep(args.politeness * (2 + random.uniform(0, 4)))
+                raise
+            finally:
+                stage_time['fetch'] += time.time() - t0
+            time.sleep(args.politeness * (1.5 + random.uniform(0, 3)))
+            return resp
+
+    def parse(response):
+        papers, dt = timed_parse(response, args.parser)
+        stage_time['parse'] += dt
+        return papers
 
+    def fetch_page(k):
         # attempt to fetch a batch of papers from arxiv api
         ntried = 0
         while True:
             try:
-                resp = get_response(search_query=q, start_index=k)
-                papers = parse_response(resp)
-                time.sleep(0.5)
+                papers = parse(fetch(k))
                 if len(papers) == 100:
-                    break # otherwise we have to try again
+                    return papers # otherwise we have to try again
             except Exception as e:
                 logging.warning(e)
                 logging.warning("will try again in a bit...")
@@ -62,25 +91,80 @@ if __name__ == '__main__':
                 if ntried > 1000:
                     logging.error("ok we tried 1,000 times, something is srsly wrong. exitting.")
                     sys.exit()
-                time.sleep(2 + random.uniform(0, 4))
-
-        # process the batch of retrieved papers
-        nhad, nnew, nreplace = 0, 0, 0
-        for p in papers:
-            pid = p['_id']
-            if pid in pdb:
-                if p['_time'] > pdb[pid]['_time']:
-                    # replace, this one is newer
-                    store(p)
-                    nreplace += 1
-                else:
-                    # we already had this paper, nothing to do
-                    nhad += 1
-            else:
-                # new, simple store into database
-                store(p)
-                nnew += 1
-        prevn = len(pdb)
+
+    def sequential_pages():
+        for k in range(args.start, args.start + args.num, 100):
+            yield k, fetch_page(k)
+
+    def pipelined_pages():
+        """
+        same pages as sequential_pages, but a fetcher thread keeps the next requests going
+        while a separate process parses the pages and we store the previous ones. in the
+        rare case a page comes back incomplete we fetch it again in the foreground
+        """
+        pages = queue.Queue(maxsize=args.prefetch)
+        stop = threading.Event()
+        # feedparser is slow python, so it runs off our GIL. spawn since we have threads running
+        pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+
+        def fetcher():
+            for k in range(args.start, args.start + args.num, 100):
+                if stop.is_set():
+                    return
+                try:
+                    job = (k, pool.submit(timed_parse, fetch(k), args.parser))
+                except Exception as e:
+                    logging.warning(e)
+                    job = (k, None)
+                while not stop.is_set():
+                    try:
+                        pages.put(job, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+            pages.put(None)
+
+        t = threading.Thread(target=fetcher, daemon=True)
+        t.start()
+        try:
+            while True:
+                job = pages.get()
+                if job is None:
+                    break
+                k, future = job
+                try:
+                    papers, dt = future.result() if future is not None else ([], 0.0)
+                    stage_time['parse'] += dt
+                except Exception as e:
+                    logging.warning(e)
+                    papers = []
+                if len(papers) != 100:
+                    logging.warning("page at start_index %d was incomplete, fetching it again" % (k, ))
+                    papers = fetch_page(k)
+                yield k, papers
+        finally:
+            # we are done or broke out early, stop the fetcher and wait for it
+            stop.set()
+            while t.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            pool.shutdown()
+
+    # fetch the latest papers
+    total_updated = 0
+    total_seen = 0
+    zero_updates_in_a_row = 0
+    t_start = time.time()
+    for k, papers in (pipelined_pages() if args.pipeline else sequential_pages()):
+
+        # store the new papers and the ones that got updated since we last saw them
+        t0 = time.time()
+        nhad, nnew, nreplace = idb.upsert(papers)
+        stage_time['store'] += time.time() - t0
+        total_seen += len(papers)
+        prevn = len(idb)
         total_updated += nreplace + nnew
 
         # some diagnostic information on how things are coming along
@@ -100,8 +184,11 @@ if __name__ == '__main__':
         else:
             zero_updates_in_a_row = 0
 
-        # zzz
-        time.sleep(1 + random.uniform(0, 3))
+    # throughput of every stage on its own, and overall
+    rate = lambda dt: total_seen / max(dt, 1e-9)
+    logging.info("ingested %d papers in %.2fs, %.1f papers/s. fetch %.1f papers/s, parse %.1f papers/s, store %.1f papers/s" %
+                 (total_seen, time.time() - t_start, rate(time.time() - t_start),
+                  rate(stage_time['fetch']), rate(stage_time['parse']), rate(stage_time['store'])))
 
     # exit with OK status if anything at all changed, but if nothing happened then raise 1
     sys.exit(0 if total_updated > 0 else 1)
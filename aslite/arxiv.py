@@ -2,18 +2,25 @@
 Utils for dealing with arxiv API and related processing
 """
 
+import io
+import os
 import time
+import calendar
 import logging
 import urllib.request
+import xml.etree.ElementTree as ET
 import feedparser
 from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-def get_response(search_query, start_index=0):
+# the arxiv api, can be pointed elsewhere (e.g. fake_arxiv.py) with the ARXIV_API_URL env var
+API_URL = os.environ.get('ARXIV_API_URL', 'http://export.arxiv.org/api/query')
+
+def get_response(search_query, start_index=0, api_url=None):
     """ pings arxiv.org API to fetch a batch of 100 papers """
     # fetch raw response
-    base_url = 'http://export.arxiv.org/api/query?'
+    base_url = (api_url or API_URL) + '?'
     add_url = 'search_query=%s&sortBy=lastUpdatedDate&start=%d&max_results=100' % (search_query, start_index)
     #add_url = 'search_query=%s&sortBy=submittedDate&start=%d&max_results=100' % (search_query, start_index)
     search_query = base_url + add_url
@@ -47,26 +54,80 @@ def parse_arxiv_url(url):
     assert len(parts) == 2, 'error splitting id and version in idv string: ' + idv
     return idv, parts[0], int(parts[1])
 
-def parse_response(response):
+def add_ids(j):
+    """ adds the id/version/time fields that we derive from the raw entry """
+    idv, rawid, version = parse_arxiv_url(j['id'])
+    j['_idv']= idv
+    j['_id'] = rawid
+    j['_version'] = version
+    j['_time'] = time.mktime(j['updated_parsed'])
+    j['_time_str'] = time.strftime('%b %d %Y', j['updated_parsed'])
+    return j
+
+def parse_response_feedparser(response):
 
     out = []
     parse = feedparser.parse(response)
     for e in parse.entries:
         j = encode_feedparser_dict(e)
-        # extract / parse id information
-        idv, rawid, version = parse_arxiv_url(j['id'])
-        j['_idv']= idv
-        j['_id'] = rawid
-        j['_version'] = version
-        j['_time'] = time.mktime(j['updated_parsed'])
-        j['_time_str'] = time.strftime('%b %d %Y', j['updated_parsed'])
         # delete apparently spurious and redundant information
         del j['summary_detail']
         del j['title_detail']
-        out.append(j)
+        out.append(add_ids(j))
 
     return out
 
+# the xml namespaces of the arxiv api responses
+ATOM = '{http://www.w3.org/2005/Atom}'
+ARXIV = '{http://arxiv.org/schemas/atom}'
+
+def parse_atom_time(s):
+    """ e.g. 2021-11-08T18:59:59Z -> UTC struct_time, same as feedparser's *_parsed fields """
+    return time.gmtime(calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')))
+
+def parse_response_etree(response):
+    """
+    a parser for just the atom schema of the arxiv api, streaming through the entries
+    with ElementTree. gives the same entries as parse_response_feedparser in all of the
+    fields that we use, and is a lot faster. see check_parser.py
+    """
+    out = []
+    for _, el in ET.iterparse(io.BytesIO(response), events=('end', )):
+        if el.tag != ATOM + 'entry':
+            continue
+        text = lambda tag: (el.findtext(tag) or '').strip()
+        j = {
+            'id': text(ATOM + 'id'),
+            'updated': text(ATOM + 'updated'),
+            'published': text(ATOM + 'published'),
+            'title': text(ATOM + 'title'),
+            'summary': text(ATOM + 'summary'),
+            'authors': [{'name': (a.findtext(ATOM + 'name') or '').strip()} for a in el.iterfind(ATOM + 'author')],
+            'tags': [{'term': c.get('term'), 'scheme': c.get('scheme'), 'label': c.get('label')}
+                     for c in el.iterfind(ATOM + 'category')],
+        }
+        j['updated_parsed'] = parse_atom_time(j['updated'])
+        j['published_parsed'] = parse_atom_time(j['published'])
+        for link in el.iterfind(ATOM + 'link'):
+            if link.get('rel', 'alternate') == 'alternate':
+                j['link'] = link.get('href')
+                break
+        for tag in ['comment', 'journal_ref', 'doi']:
+            v = el.findtext(ARXIV + tag)
+            if v is not None:
+                j['arxiv_' + tag] = v.strip()
+        out.append(add_ids(j))
+        el.clear() # we are done with this entry, free its memory
+    return out
+
+PARSERS = {
+    'etree': parse_response_etree,
+    'feedparser': parse_response_feedparser,
+}
+
+def parse_response(response, parser='etree'):
+    return PARSERS[parser](response)
+
 def filter_latest_version(idvs):
     """
     for each idv filter the list down to only the most recent version
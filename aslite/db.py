@@ -5,10 +5,24 @@ Any of the file system I/O and the associated settings are in this single file.
 """
 
 import os
+import time
+import random
+import json
+import shutil
+import struct
+import threading
 import sqlite3, zlib, pickle, tempfile
 from sqlitedict import SqliteDict
 from contextlib import contextmanager
 
+import numpy as np
+from scipy.sparse import csr_matrix
+
+try:
+    import zstandard # optional, we fall back to zlib without it
+except ImportError:
+    zstandard = None
+
 # -----------------------------------------------------------------------------
 # global configuration
 
@@ -92,6 +106,560 @@ class CompressedSqliteDict(SqliteDict):
 
         super().__init__(*args, **kwargs, encode=encode, decode=decode)
 
+"""
+The papers table stores a compact, versioned record per paper: just the fields that the
+app actually uses, as a fixed-order json array instead of a pickle of the whole feedparser
+entry, compressed with zstd using a dictionary trained on the papers (see migrate.py papers)
+that is shared across all records. Each blob starts with a small header:
+
+byte 0     record format version (1), old rows are zlib'd pickles which start with 0x78
+byte 1     codec: 1 = zlib, 2 = zstd
+bytes 2-5  id of the zstd dictionary in the codec_dicts table, or 0 for no dictionary
+
+old rows keep being readable, and are rewritten in the new format by migrate.py papers.
+"""
+
+PAPER_RECORD_VERSION = 1
+PAPER_FIELDS = ['_id', '_idv', '_version', '_time', '_time_str', 'title', 'summary', 'link', 'authors', 'tags']
+CODEC_ZLIB, CODEC_ZSTD = 1, 2
+
+# the zstd dictionaries are immutable, so we load them once per process and share them
+_zstd_dicts = {} # (filename, id) -> zstandard.ZstdCompressionDict
+_zstd_dicts_lock = threading.Lock()
+
+def encode_paper(p):
+    """ the compact json record of a paper, from its feedparser-derived dict """
+    rec = [p[k] for k in PAPER_FIELDS[:-2]]
+    rec.append([a['name'] for a in p['authors']])
+    rec.append([t['term'] for t in p['tags']])
+    return json.dumps(rec, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def decode_paper(data):
+    """ inverse of encode_paper, returns the paper in the same shape that the feedparser dict had """
+    rec = json.loads(data)
+    p = dict(zip(PAPER_FIELDS[:-2], rec))
+    p['authors'] = [{'name': a} for a in rec[-2]]
+    p['tags'] = [{'term': t} for t in rec[-1]]
+    return p
+
+class PaperCodec:
+    """ encodes and decodes the blobs of the papers table, see above """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dict_id = 0
+        self.compressor = None
+        self.decompressors = {}
+        if zstandard is not None:
+            self.dict_id = self.latest_dict_id()
+            zdict = self.get_dict(self.dict_id) if self.dict_id else None
+            self.compressor = zstandard.ZstdCompressor(level=9, dict_data=zdict)
+
+    def _connect(self):
+        return sqlite3.connect('file:%s?mode=ro' % (os.path.abspath(self.filename), ), uri=True)
+
+    def latest_dict_id(self):
+        if not os.path.isfile(self.filename):
+            return 0
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT MAX(id) FROM codec_dicts").fetchone()
+        except sqlite3.OperationalError:
+            row = None # no dictionaries table yet
+        conn.close()
+        return row[0] if row and row[0] else 0
+
+    def get_dict(self, dict_id):
+        key = (os.path.abspath(self.filename), dict_id)
+        with _zstd_dicts_lock:
+            if key not in _zstd_dicts:
+                conn = self._connect()
+                data = conn.execute("SELECT dict FROM codec_dicts WHERE id = ?", (dict_id, )).fetchone()[0]
+                conn.close()
+                _zstd_dicts[key] = zstandard.ZstdCompressionDict(bytes(data))
+            return _zstd_dicts[key]
+
+    def encode(self, p):
+        data = encode_paper(p)
+        if self.compressor is not None:
+            header = struct.pack('>BBI', PAPER_RECORD_VERSION, CODEC_ZSTD, self.dict_id)
+            return sqlite3.Binary(header + self.compressor.compress(data))
+        header = struct.pack('>BBI', PAPER_RECORD_VERSION, CODEC_ZLIB, 0)
+        return sqlite3.Binary(header + zlib.compress(data))
+
+    def decode(self, blob):
+        blob = bytes(blob)
+        if blob[0] != PAPER_RECORD_VERSION:
+            return pickle.loads(zlib.decompress(blob)) # an old row, a zlib'd pickle of the full dict
+        _, codec, dict_id = struct.unpack('>BBI', blob[:6])
+        if codec == CODEC_ZLIB:
+            return decode_paper(zlib.decompress(blob[6:]))
+        assert codec == CODEC_ZSTD, 'unknown codec %d' % (codec, )
+        assert zstandard is not None, 'this papers db needs the zstandard package, pip install zstandard'
+        if dict_id not in self.decompressors:
+            zdict = self.get_dict(dict_id) if dict_id else None
+            self.decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=zdict)
+        return decode_paper(self.decompressors[dict_id].decompress(blob[6:]))
+
+class PapersDict(SqliteDict):
+    """ the papers table, storing the compact paper records of PaperCodec """
+
+    def __init__(self, filename, *args, **kwargs):
+        self.codec = PaperCodec(filename)
+        super().__init__(filename, *args, **kwargs, encode=self.codec.encode, decode=self.codec.decode)
+
+    def get_many(self, pids, batch_size=500):
+        """ returns {pid: paper} for the given pids (skipping any unknown ones), a batch per query """
+        pids = list(pids)
+        out = {}
+        for i in range(0, len(pids), batch_size):
+            batch = pids[i:i+batch_size]
+            req = 'SELECT key, value FROM "%s" WHERE key IN (%s)' % (self.tablename, ','.join('?' * len(batch)))
+            for k, v in self.conn.select(req, tuple(batch)): # the keys are plain text, like IngestDB writes them
+                out[k] = self.decode(v)
+        return out
+
+def train_papers_dict(pdb, num_samples=10000, dict_size=112640):
+    """
+    trains a new zstd dictionary on a random sample of the papers, stores it into the
+    codec_dicts table of the papers db and returns its id. new writes will use it.
+    """
+    assert zstandard is not None, 'training a dictionary needs the zstandard package, pip install zstandard'
+    keys = list(pdb.keys())
+    random.shuffle(keys)
+    samples = [encode_paper(pdb[k]) for k in keys[:num_samples]]
+    zdict = zstandard.train_dictionary(dict_size, samples)
+    with sqlite3.connect(pdb.filename) as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS codec_dicts (id INTEGER PRIMARY KEY, dict BLOB NOT NULL)")
+        dict_id = conn.execute("INSERT INTO codec_dicts (dict) VALUES (?)", (zdict.as_bytes(), )).lastrowid
+    conn.close()
+    return dict_id
+
+class SqliteTable:
+    """
+    Base class for the tables that we manage with plain sql instead of sqlitedict,
+    because they need indexes, full-text search, or other things that a simple
+    key-value store can't give us. Subclasses create their schema in create().
+    Supports the same flag/autocommit semantics and context manager as SqliteDict.
+    """
+
+    def __init__(self, filename, flag='r', autocommit=True, timeout=30):
+        assert flag in ['r', 'c']
+        self.filename = filename
+        self.flag = flag
+        self.autocommit = autocommit
+        if flag == 'r':
+            uri = 'file:%s?mode=ro' % (os.path.abspath(filename), )
+            self.conn = sqlite3.connect(uri, uri=True, timeout=timeout, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(filename, timeout=timeout, check_same_thread=False)
+            self.create()
+            self.conn.commit()
+
+    def create(self):
+        pass
+
+    def has_table(self, name):
+        row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name, )).fetchone()
+        return row is not None
+
+    def maybe_commit(self):
+        if self.autocommit:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        if self.flag == 'c':
+            self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class MetasDB(SqliteTable):
+    """
+    The lightweight metadata of every paper (atm just its time) as a proper table
+    with an index on time, so we can page through the papers in time order without
+    reading and sorting all of them. Quacks like the SqliteDict of {pid: {'_time': t}}
+    that it replaces. The old sqlitedict table is migrated over automatically.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.has_table('metas_idx'):
+            self.conn.close()
+            raise RuntimeError("table metas_idx does not exist in %s, run `python migrate.py metas`" % (self.filename, ))
+
+    def create(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS metas_idx (
+                pid TEXT PRIMARY KEY,
+                time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS metas_idx_time ON metas_idx (time);
+        """)
+        # one-time migration from the old sqlitedict "metas" table of pickled dicts. the old table
+        # is renamed in the same transaction, so that we never migrate it over a second time
+        if self.has_table('metas'):
+            with self.conn:
+                rows = self.conn.execute("SELECT key, value FROM metas")
+                self.conn.executemany("INSERT OR IGNORE INTO metas_idx (pid, time) VALUES (?, ?)",
+                                      ((k, pickle.loads(bytes(v))['_time']) for k, v in rows))
+                self.conn.execute("ALTER TABLE metas RENAME TO metas_migrated")
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM metas_idx").fetchone()[0]
+
+    def __contains__(self, pid):
+        return self.conn.execute("SELECT 1 FROM metas_idx WHERE pid = ?", (pid, )).fetchone() is not None
+
+    def __getitem__(self, pid):
+        row = self.conn.execute("SELECT time FROM metas_idx WHERE pid = ?", (pid, )).fetchone()
+        if row is None:
+            raise KeyError(pid)
+        return {'_time': row[0]}
+
+    def __setitem__(self, pid, meta):
+        self.conn.execute("INSERT OR REPLACE INTO metas_idx (pid, time) VALUES (?, ?)", (pid, meta['_time']))
+        self.maybe_commit()
+
+    def get(self, pid, default=None):
+        try:
+            return self[pid]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute("SELECT pid FROM metas_idx ORDER BY rowid")]
+
+    def items(self):
+        for pid, t in self.conn.execute("SELECT pid, time FROM metas_idx ORDER BY rowid"):
+            yield pid, {'_time': t}
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def columns(self):
+        """ returns the pids and the times of all papers as two parallel lists, in one query """
+        rows = self.conn.execute("SELECT pid, time FROM metas_idx ORDER BY rowid").fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    def count(self, tmin=None):
+        """ number of papers, optionally only those more recent than tmin """
+        tmin = float('-inf') if tmin is None else tmin
+        return self.conn.execute("SELECT COUNT(*) FROM metas_idx WHERE time > ?", (tmin, )).fetchone()[0]
+
+    def latest(self, tmin=None, offset=0, limit=-1):
+        """
+        yields (pid, time) from the most recent paper to the oldest, optionally only those
+        more recent than tmin, and optionally just a page of them (limit -1 means no limit)
+        """
+        tmin = float('-inf') if tmin is None else tmin
+        yield from self.conn.execute("""
+            SELECT pid, time FROM metas_idx WHERE time > ? ORDER BY time DESC LIMIT ? OFFSET ?
+        """, (tmin, limit, offset))
+
+class DocsDB(SqliteTable):
+    """
+    The plain text of every paper (title, authors, summary) in a regular table,
+    with an external-content FTS5 index over it that triggers keep in sync.
+    This is what powers search without decompressing every paper in the db.
+    """
+
+    def create(self):
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY,
+                pid TEXT UNIQUE NOT NULL,
+                title TEXT NOT NULL,
+                authors TEXT NOT NULL,
+                summary TEXT NOT NULL
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(
+                title, authors, summary, content='docs', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS docs_ai AFTER INSERT ON docs BEGIN
+                INSERT INTO docs_fts(rowid, title, authors, summary)
+                VALUES (new.id, new.title, new.authors, new.summary);
+            END;
+            CREATE TRIGGER IF NOT EXISTS docs_ad AFTER DELETE ON docs BEGIN
+                INSERT INTO docs_fts(docs_fts, rowid, title, authors, summary)
+                VALUES ('delete', old.id, old.title, old.authors, old.summary);
+            END;
+            CREATE TRIGGER IF NOT EXISTS docs_au AFTER UPDATE ON docs BEGIN
+                INSERT INTO docs_fts(docs_fts, rowid, title, authors, summary)
+                VALUES ('delete', old.id, old.title, old.authors, old.summary);
+                INSERT INTO docs_fts(rowid, title, authors, summary)
+                VALUES (new.id, new.title, new.authors, new.summary);
+            END;
+        """)
+
+    def __len__(self):
+        if not self.has_table('docs'):
+            return 0
+        return self.conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def num_missing(self):
+        """
+        how many of the papers (in metas_idx) the index is missing, e.g. because an existing db
+        didn't run `python migrate.py search` yet and the daemon only indexed its new papers
+        """
+        if not self.has_table('docs') or not self.has_table('metas_idx'):
+            return None
+        nmetas = self.conn.execute("SELECT COUNT(*) FROM metas_idx").fetchone()[0]
+        return max(0, nmetas - len(self))
+
+    def __setitem__(self, pid, p):
+        """ upsert a paper (as stored in the papers table) into the index """
+        self.conn.execute(self.UPSERT, self.row(pid, p))
+        self.maybe_commit()
+
+    UPSERT = """
+        INSERT INTO docs (pid, title, authors, summary) VALUES (?, ?, ?, ?)
+        ON CONFLICT(pid) DO UPDATE SET
+            title = excluded.title, authors = excluded.authors, summary = excluded.summary
+    """
+
+    @staticmethod
+    def row(pid, p):
+        return (pid, p['title'], ', '.join(a['name'] for a in p['authors']), p['summary'])
+
+    def keys(self):
+        return [r[0] for r in self.conn.execute("SELECT pid FROM docs ORDER BY id")]
+
+    def iter_docs(self, batch_size=10000):
+        """
+        streams (pid, title, authors, summary) of all papers in the order they were
+        added, reading them with a single cursor in large batches
+        """
+        cursor = self.conn.execute("SELECT pid, title, authors, summary FROM docs ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def get_many(self, pids, batch_size=500):
+        """ returns {pid: (title, authors, summary)} for the given pids, a batch per query """
+        pids = list(pids)
+        out = {}
+        for i in range(0, len(pids), batch_size):
+            batch = pids[i:i+batch_size]
+            rows = self.conn.execute("SELECT pid, title, authors, summary FROM docs WHERE pid IN (%s)"
+                                     % (','.join('?' * len(batch)), ), batch)
+            out.update((r[0], r[1:]) for r in rows)
+        return out
+
+    def backfill(self, pdb):
+        """ adds the papers of the papers db that are missing from the docs, returns how many """
+        have = set(r[0] for r in self.conn.execute("SELECT pid FROM docs"))
+        missing = [pid for pid in pdb.keys() if pid not in have]
+        for pid in missing:
+            self[pid] = pdb[pid]
+        self.maybe_commit()
+        return len(missing)
+
+    def search(self, qs):
+        """
+        yields (pid, title, authors, summary) of all papers that contain a word
+        starting with any of the query parts qs in any of their text fields
+        """
+        # every query part becomes a quoted prefix query, OR'd together
+        match = ' OR '.join('"%s"*' % (qp.replace('"', '""'), ) for qp in qs)
+        cursor = self.conn.execute("""
+            SELECT docs.pid, docs.title, docs.authors, docs.summary
+            FROM docs_fts JOIN docs ON docs.id = docs_fts.rowid
+            WHERE docs_fts MATCH ?
+        """, (match, ))
+        yield from cursor
+
+    def rebuild(self):
+        """ rebuild the full-text index from scratch from the docs table """
+        self.conn.execute("INSERT INTO docs_fts(docs_fts) VALUES ('rebuild')")
+        self.maybe_commit()
+
+class IngestDB(SqliteTable):
+    """
+    The write side of the papers, metas_idx and docs tables (that all live in the papers db)
+    for ingesting papers from the arxiv api in bulk. A batch of papers is checked against
+    the metas with one query and then written to all three tables in one transaction,
+    instead of a decode, a few lookups and three committed writes per paper.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.codec = PaperCodec(self.filename)
+
+    def create(self):
+        # the table of the papers SqliteDict, same schema as sqlitedict creates
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "papers" (key TEXT PRIMARY KEY, value BLOB)')
+        MetasDB.create(self)
+        DocsDB.create(self)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM metas_idx").fetchone()[0]
+
+    def upsert(self, papers, batch_size=500):
+        """
+        stores the papers that are new, or newer than the version we have, returns
+        the number of papers that we (already) had, that are new, and that were replaced
+        """
+        # when do we have each of these papers from, if at all
+        pids = list(set(p['_id'] for p in papers))
+        have = {}
+        for i in range(0, len(pids), batch_size):
+            batch = pids[i:i+batch_size]
+            have.update(self.conn.execute("SELECT pid, time FROM metas_idx WHERE pid IN (%s)"
+                                          % (','.join('?' * len(batch)), ), batch))
+
+        # figure out which of the papers we need to write
+        nhad, nnew, nreplace = 0, 0, 0
+        todo = {}
+        for p in papers:
+            pid = p['_id']
+            if pid in have:
+                if p['_time'] > have[pid]:
+                    nreplace += 1 # replace, this one is newer
+                else:
+                    nhad += 1 # we already had this paper, nothing to do
+                    continue
+            else:
+                nnew += 1
+            have[pid] = p['_time']
+            todo[pid] = p
+
+        # and write them all in a single transaction
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO "papers" (key, value) VALUES (?, ?)',
+                                  ((pid, self.codec.encode(p)) for pid, p in todo.items()))
+            self.conn.executemany("INSERT OR REPLACE INTO metas_idx (pid, time) VALUES (?, ?)",
+                                  ((pid, p['_time']) for pid, p in todo.items()))
+            self.conn.executemany(DocsDB.UPSERT, (DocsDB.row(pid, p) for pid, p in todo.items()))
+        return nhad, nnew, nreplace
+
+class TagsDB(SqliteTable):
+    """
+    The tags of all users as one (user, tag, pid, added_at) row per tagged paper, so that
+    tagging or untagging a paper is a single row insert/delete instead of a rewrite of the
+    whole library of the user, and concurrent edits can't lose each other. Quacks like the
+    SqliteDict of {user: {tag: set(pids)}} that it replaces, which is migrated over automatically.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.has_table('user_tags'):
+            self.conn.close()
+            raise RuntimeError("table user_tags does not exist in %s, run `python migrate.py tags`" % (self.filename, ))
+
+    def create(self):
+        # the primary key index serves the lookups by user, and by user and tag
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS user_tags (
+                user TEXT NOT NULL,
+                tag TEXT NOT NULL,
+                pid TEXT NOT NULL,
+                added_at REAL NOT NULL,
+                PRIMARY KEY (user, tag, pid)
+            );
+        """)
+        # one-time migration from the old sqlitedict "tags" table of zlib'd pickles of the
+        # whole library. we don't know when those papers were tagged, so they get the time of now.
+        # the old table is renamed in the same transaction, so that deleted tags don't come back
+        if self.has_table('tags'):
+            tnow = time.time()
+            with self.conn:
+                rows = self.conn.execute("SELECT key, value FROM tags").fetchall()
+                self.conn.executemany("INSERT OR IGNORE INTO user_tags (user, tag, pid, added_at) VALUES (?, ?, ?, ?)",
+                                      ((user, tag, pid, tnow) for user, v in rows
+                                       for tag, pids in pickle.loads(zlib.decompress(bytes(v))).items()
+                                       for pid in pids))
+                self.conn.execute("ALTER TABLE tags RENAME TO tags_migrated")
+
+    # single row edits
+
+    def add(self, user, tag, pid):
+        """ adds the paper to the tag of the user, returns False if it was already there """
+        cursor = self.conn.execute("INSERT OR IGNORE INTO user_tags (user, tag, pid, added_at) VALUES (?, ?, ?, ?)",
+                                   (user, tag, pid, time.time()))
+        self.maybe_commit()
+        return cursor.rowcount > 0
+
+    def remove(self, user, tag, pid):
+        """ removes the paper from the tag of the user, returns False if it wasn't there """
+        cursor = self.conn.execute("DELETE FROM user_tags WHERE user = ? AND tag = ? AND pid = ?", (user, tag, pid))
+        self.maybe_commit()
+        return cursor.rowcount > 0
+
+    def delete_tag(self, user, tag):
+        """ deletes the whole tag of the user, returns the number of papers that were in it """
+        cursor = self.conn.execute("DELETE FROM user_tags WHERE user = ? AND tag = ?", (user, tag))
+        self.maybe_commit()
+        return cursor.rowcount
+
+    def has_tag(self, user, tag):
+        row = self.conn.execute("SELECT 1 FROM user_tags WHERE user = ? AND tag = ? LIMIT 1", (user, tag)).fetchone()
+        return row is not None
+
+    # the dict-like interface, the tags (and their papers) come back in the order they were added
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(DISTINCT user) FROM user_tags").fetchone()[0]
+
+    def __contains__(self, user):
+        return self.conn.execute("SELECT 1 FROM user_tags WHERE user = ? LIMIT 1", (user, )).fetchone() is not None
+
+    def __getitem__(self, user):
+        d = {}
+        for tag, pid in self.conn.execute("SELECT tag, pid FROM user_tags WHERE user = ? ORDER BY rowid", (user, )):
+            d.setdefault(tag, set()).add(pid)
+        if not d:
+            raise KeyError(user)
+        return d
+
+    def __setitem__(self, user, d):
+        """ replaces the whole library of the user, keeping the added_at of the papers that stay """
+        with self.conn:
+            rows = set((tag, pid) for tag, pids in d.items() for pid in pids)
+            have = set(self.conn.execute("SELECT tag, pid FROM user_tags WHERE user = ?", (user, )))
+            self.conn.executemany("DELETE FROM user_tags WHERE user = ? AND tag = ? AND pid = ?",
+                                  ((user, tag, pid) for tag, pid in have - rows))
+            tnow = time.time()
+            self.conn.executemany("INSERT INTO user_tags (user, tag, pid, added_at) VALUES (?, ?, ?, ?)",
+                                  ((user, tag, pid, tnow) for tag, pid in rows - have))
+
+    def __delitem__(self, user):
+        self.conn.execute("DELETE FROM user_tags WHERE user = ?", (user, ))
+        self.maybe_commit()
+
+    def get(self, user, default=None):
+        try:
+            return self[user]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT user FROM user_tags ORDER BY user")]
+
+    def items(self):
+        """ yields (user, {tag: set(pids)}) of all users, reading all of the tags in one query """
+        d, prev = {}, None
+        for user, tag, pid in self.conn.execute("SELECT user, tag, pid FROM user_tags ORDER BY user, rowid"):
+            if user != prev and prev is not None:
+                yield prev, d
+                d = {}
+            prev = user
+            d.setdefault(tag, set()).add(pid)
+        if prev is not None:
+            yield prev, d
+
+    def __iter__(self):
+        return iter(self.keys())
+
 # -----------------------------------------------------------------------------
 """
 some docs to self:
@@ -104,19 +672,37 @@ PAPERS_DB_FILE = os.path.join(DATA_DIR, 'papers.db')
 # stores account-relevant info, like which tags exist for which papers
 DICT_DB_FILE = os.path.join(DATA_DIR, 'dict.db')
 
+def papers_version():
+    """ returns a cheap token that changes whenever the papers db file is written to """
+    try:
+        st = os.stat(PAPERS_DB_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
 def get_papers_db(flag='r', autocommit=True):
     assert flag in ['r', 'c']
-    pdb = CompressedSqliteDict(PAPERS_DB_FILE, tablename='papers', flag=flag, autocommit=autocommit)
+    pdb = PapersDict(PAPERS_DB_FILE, tablename='papers', flag=flag, autocommit=autocommit)
     return pdb
 
 def get_metas_db(flag='r', autocommit=True):
     assert flag in ['r', 'c']
-    mdb = SqliteDict(PAPERS_DB_FILE, tablename='metas', flag=flag, autocommit=autocommit)
+    mdb = MetasDB(PAPERS_DB_FILE, flag=flag, autocommit=autocommit)
     return mdb
 
+def get_docs_db(flag='r', autocommit=True):
+    assert flag in ['r', 'c']
+    ddb = DocsDB(PAPERS_DB_FILE, flag=flag, autocommit=autocommit)
+    return ddb
+
+def get_ingest_db(flag='c', autocommit=True):
+    assert flag == 'c'
+    idb = IngestDB(PAPERS_DB_FILE, flag=flag, autocommit=autocommit)
+    return idb
+
 def get_tags_db(flag='r', autocommit=True):
     assert flag in ['r', 'c']
-    tdb = CompressedSqliteDict(DICT_DB_FILE, tablename='tags', flag=flag, autocommit=autocommit)
+    tdb = TagsDB(DICT_DB_FILE, flag=flag, autocommit=autocommit)
     return tdb
 
 def get_last_active_db(flag='r', autocommit=True):
@@ -129,20 +715,157 @@ def get_email_db(flag='r', autocommit=True):
     edb = SqliteDict(DICT_DB_FILE, tablename='email', flag=flag, autocommit=autocommit)
     return edb
 
+def get_outbox_db(flag='r', autocommit=True):
+    """ '<run>/<user>' -> the email of the run to the user, and whether it went out yet. see aslite/mailer.py """
+    assert flag in ['r', 'c']
+    odb = CompressedSqliteDict(DICT_DB_FILE, tablename='outbox', flag=flag, autocommit=autocommit)
+    return odb
+
+def get_sent_db(flag='r', autocommit=True):
+    """ user -> {'tags_hash', 'features_version', 'pids'} of the last recommendations email we sent them """
+    assert flag in ['r', 'c']
+    sdb = CompressedSqliteDict(DICT_DB_FILE, tablename='sent', flag=flag, autocommit=autocommit)
+    return sdb
+
+def get_thumb_failures_db(flag='r', autocommit=True):
+    """ pid -> {'reason', 'attempts', 'last_time', 'next_retry'} of the papers that thumb_daemon.py failed on """
+    assert flag in ['r', 'c']
+    fdb = SqliteDict(DICT_DB_FILE, tablename='thumb_failures', flag=flag, autocommit=autocommit)
+    return fdb
+
 # -----------------------------------------------------------------------------
 """
-our "feature store" is currently just a pickle file, may want to consider hdf5 in the future
+our "feature store" is a directory of raw numpy arrays that we open with mmap, so that
+the OS pages them in lazily and shares them between all the processes (gunicorn workers,
+cron scripts) that have the features open, instead of each holding a private heap copy.
+
+data/features/CURRENT          <- name of the current version, swapped atomically
+data/features/<version>/*.npy  <- x (as csr data/indices/indptr), pids, vocab, idf, ...
+
+the old single pickle file format is still read if no features directory exists yet.
 """
 
 # stores tfidf features a bunch of other metadata
-FEATURES_FILE = os.path.join(DATA_DIR, 'features.p')
+FEATURES_DIR = os.path.join(DATA_DIR, 'features')
+FEATURES_CURRENT = os.path.join(FEATURES_DIR, 'CURRENT')
+FEATURES_FILE = os.path.join(DATA_DIR, 'features.p') # legacy format
 
 def save_features(features):
-    """ takes the features dict and save it to disk in a simple pickle file """
-    safe_pickle_dump(features, FEATURES_FILE)
+    """
+    takes the features dict and saves it to disk as a new version of the features
+    directory. every numpy array value is stored as its own .npy file, the rest
+    of the (small) values go into a pickle.
+    """
+    os.makedirs(FEATURES_DIR, exist_ok=True)
+
+    # write everything into a fresh temporary directory first
+    tmpdir = tempfile.mkdtemp(dir=FEATURES_DIR, prefix='.tmp')
+    x = features['x'].tocsr()
+    arrays = {
+        'x_data': x.data,
+        'x_indices': x.indices,
+        'x_indptr': x.indptr,
+        'pids': np.array(features['pids'], dtype=str),
+        'ivocab': np.array(sorted(features['vocab'], key=features['vocab'].get), dtype=str),
+        'idf': np.asarray(features['idf']),
+    }
+    extra = {'x_shape': x.shape}
+    for k, v in features.items():
+        if k in ['x', 'pids', 'vocab', 'idf']:
+            continue
+        if isinstance(v, np.ndarray):
+            arrays[k] = v
+        else:
+            extra[k] = v
+    for k, v in arrays.items():
+        np.save(os.path.join(tmpdir, k + '.npy'), v)
+    with open(os.path.join(tmpdir, 'extra.p'), 'wb') as f:
+        pickle.dump(extra, f, -1)
+
+    # then move it into place and atomically point CURRENT at it
+    version = '%d' % (time.time_ns(), )
+    os.rename(tmpdir, os.path.join(FEATURES_DIR, version))
+    with open_atomic(FEATURES_CURRENT, 'w') as f:
+        f.write(version)
+
+    # clean up all but the two most recent versions, processes may still have the previous one open
+    versions = sorted(v for v in os.listdir(FEATURES_DIR) if v.isdigit())
+    for v in versions[:-2]:
+        shutil.rmtree(os.path.join(FEATURES_DIR, v), ignore_errors=True)
 
 def load_features():
-    """ loads the features dict from disk """
-    with open(FEATURES_FILE, 'rb') as f:
+    """
+    loads the features dict from disk. the arrays are memory-mapped read-only and
+    x is a zero-copy scipy csr_matrix view over them.
+    """
+    if not os.path.isfile(FEATURES_CURRENT):
+        with open(FEATURES_FILE, 'rb') as f:
+            features = pickle.load(f)
+        return features
+
+    with open(FEATURES_CURRENT, 'r') as f:
+        vdir = os.path.join(FEATURES_DIR, f.read().strip())
+    with open(os.path.join(vdir, 'extra.p'), 'rb') as f:
         features = pickle.load(f)
+    for fname in os.listdir(vdir):
+        if fname.endswith('.npy'):
+            features[fname[:-4]] = np.load(os.path.join(vdir, fname), mmap_mode='r')
+
+    x_shape = features.pop('x_shape')
+    x_data, x_indices, x_indptr = features.pop('x_data'), features.pop('x_indices'), features.pop('x_indptr')
+    features['x'] = csr_matrix((x_data, x_indices, x_indptr), shape=x_shape, copy=False)
+    features['pids'] = features['pids'].tolist()
+    features['vocab'] = {w:i for i, w in enumerate(features.pop('ivocab').tolist())}
     return features
+
+def features_version():
+    """
+    returns a cheap token that changes whenever save_features writes new features,
+    so long-running processes can tell when to reload. None if there are no features
+    """
+    for fname in [FEATURES_CURRENT, FEATURES_FILE]:
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            continue
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    return None
+
+# -----------------------------------------------------------------------------
+"""
+thumbnails of the papers live in static/thumb/<pid>.jpg, and thumb_daemon.py keeps a
+manifest of them in data/thumbs.p, {pid: (size, mtime)}, so that the server and the
+daemon know which thumbnails exist without probing the filesystem one paper at a time.
+"""
+
+THUMB_DIR = os.path.join('static', 'thumb')
+THUMBS_FILE = os.path.join(DATA_DIR, 'thumbs.p')
+
+def scan_thumbs():
+    """ builds the manifest from a listing of the thumb directory """
+    thumbs = {}
+    if os.path.isdir(THUMB_DIR):
+        for entry in os.scandir(THUMB_DIR):
+            if entry.name.endswith('.jpg'):
+                st = entry.stat()
+                thumbs[entry.name[:-4]] = (st.st_size, st.st_mtime)
+    return thumbs
+
+def load_thumbs():
+    """ the manifest of the available thumbnails, or a fresh scan if there is no manifest yet """
+    if not os.path.isfile(THUMBS_FILE):
+        return scan_thumbs()
+    with open(THUMBS_FILE, 'rb') as f:
+        thumbs = pickle.load(f)
+    return thumbs
+
+def save_thumbs(thumbs):
+    safe_pickle_dump(thumbs, THUMBS_FILE)
+
+def thumbs_version():
+    """ a cheap token that changes whenever the manifest is written, None if there is none """
+    try:
+        st = os.stat(THUMBS_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
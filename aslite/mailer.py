@@ -0,0 +1,178 @@
+"""
+Delivery of the recommendation emails: a few transports that know how to send one
+email, and a Mailer that sends many of them concurrently through one transport, retrying
+failures with backoff. Every email goes through a persistent outbox first, so that a run
+that crashed halfway can be resumed without sending anyone the same email twice.
+"""
+
+import os
+import json
+import time
+import random
+import smtplib
+import threading
+import urllib.request
+from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+
+FROM_EMAIL = 'admin@arxiv-sanity-lite.com'
+
+# -----------------------------------------------------------------------------
+# transports, each with a send(to, subject, html) that raises if the email did not go out
+
+class SendGridTransport:
+    """ the sendgrid api, with the api key in sendgrid_api_key.txt (pip install sendgrid) """
+
+    def __init__(self, api_key_file='sendgrid_api_key.txt'):
+        import sendgrid # only needed for this transport
+        assert os.path.isfile(api_key_file), 'sendgrid api key not found in %s' % (api_key_file, )
+        with open(api_key_file, 'r') as f:
+            api_key = f.read().strip()
+        self.sg = sendgrid.SendGridAPIClient(api_key=api_key)
+
+    def send(self, to, subject, html):
+        from sendgrid.helpers.mail import Email, To, Content, Mail
+        mail = Mail(Email(FROM_EMAIL), To(to), subject, Content("text/html", html))
+        response = self.sg.client.mail.send.post(request_body=mail.get())
+        if response.status_code >= 300:
+            raise RuntimeError('sendgrid returned status %d' % (response.status_code, ))
+
+class SMTPTransport:
+    """ any smtp server, with a connection per thread that is reused across emails """
+
+    def __init__(self, host, port=587, user=None, password=None, starttls=True):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.starttls = starttls
+        self.local = threading.local()
+
+    def connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.user:
+            server.login(self.user, self.password)
+        return server
+
+    def send(self, to, subject, html):
+        msg = MIMEText(html, 'html', 'utf-8')
+        msg['Subject'], msg['From'], msg['To'] = subject, FROM_EMAIL, to
+        if getattr(self.local, 'server', None) is None:
+            self.local.server = self.connect()
+        try:
+            self.local.server.sendmail(FROM_EMAIL, [to], msg.as_string())
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self.local.server = None # reconnect on the next attempt
+            raise
+
+class FileTransport:
+    """ for testing: writes every email as a json file into a directory """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def send(self, to, subject, html):
+        fname = os.path.join(self.directory, '%d_%s.json' % (time.time_ns(), to))
+        with open(fname, 'w') as f:
+            json.dump({'from': FROM_EMAIL, 'to': to, 'subject': subject, 'html': html}, f)
+
+class HTTPTransport:
+    """ for testing: POSTs every email as json to a url, e.g. of some local mail sink """
+
+    def __init__(self, url):
+        self.url = url
+
+    def send(self, to, subject, html):
+        data = json.dumps({'from': FROM_EMAIL, 'to': to, 'subject': subject, 'html': html}).encode('utf-8')
+        req = urllib.request.Request(self.url, data=data, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req, timeout=30) as response:
+            response.read()
+
+def get_transport(name, sink=None, smtp_host=None, smtp_port=587):
+    """ the transport of the given name, smtp credentials come from the SMTP_USER/SMTP_PASSWORD env vars """
+    if name == 'sendgrid':
+        return SendGridTransport()
+    if name == 'smtp':
+        return SMTPTransport(smtp_host, smtp_port, os.environ.get('SMTP_USER'), os.environ.get('SMTP_PASSWORD'))
+    if name == 'file':
+        return FileTransport(sink)
+    if name == 'http':
+        return HTTPTransport(sink)
+    raise ValueError('unknown transport %s' % (name, ))
+
+# -----------------------------------------------------------------------------
+
+class Mailer:
+    """
+    Sends emails through a transport with up to `workers` of them in flight at a time,
+    retrying every email up to `retries` times with exponential backoff. The outbox
+    (a dict-like, e.g. get_outbox_db) tracks the status of every email by its key.
+    If given, on_sent(key, meta) is called (from a worker thread) once an email went out,
+    with the meta that it was submitted with, also for the emails that resume() sends.
+    """
+
+    def __init__(self, transport, outbox, workers=8, retries=5, backoff=2.0, on_sent=None):
+        self.transport = transport
+        self.outbox = outbox
+        self.on_sent = on_sent
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = threading.BoundedSemaphore(2 * workers) # bound how many emails we hold in memory
+        self.lock = threading.Lock()
+        self.queued = set() # keys that we handed to the executor already
+        self.num_sent, self.num_failed = 0, 0
+
+    def was_sent(self, key):
+        return key in self.outbox and self.outbox[key]['status'] == 'sent'
+
+    def submit(self, key, to, subject, html, meta=None):
+        """ queues an email for delivery, unless the email with this key already went out or is queued """
+        if self.was_sent(key) or key in self.queued:
+            return
+        self.outbox[key] = {'to': to, 'subject': subject, 'html': html, 'status': 'pending', 'attempts': 0, 'meta': meta}
+        self._queue(key)
+
+    def resume(self):
+        """ queues all the emails in the outbox that did not go out yet, e.g. because we crashed """
+        for key, msg in list(self.outbox.items()):
+            if msg['status'] != 'sent' and key not in self.queued:
+                self._queue(key)
+
+    def _queue(self, key):
+        self.queued.add(key)
+        self.slots.acquire() # blocks while too many emails are in flight
+        self.executor.submit(self._deliver, key)
+
+    def _deliver(self, key):
+        try:
+            msg = self.outbox[key]
+            for attempt in range(self.retries):
+                try:
+                    self.transport.send(msg['to'], msg['subject'], msg['html'])
+                    msg['status'] = 'sent'
+                    break
+                except Exception as e:
+                    msg['error'] = repr(e)
+                    print("sending %s failed (attempt %d/%d): %s" % (key, attempt + 1, self.retries, e))
+                    if attempt + 1 < self.retries:
+                        time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+            else:
+                msg['status'] = 'failed'
+            msg['attempts'] += attempt + 1
+            self.outbox[key] = msg
+            if msg['status'] == 'sent' and self.on_sent is not None:
+                self.on_sent(key, msg.get('meta'))
+            with self.lock:
+                if msg['status'] == 'sent':
+                    self.num_sent += 1
+                else:
+                    self.num_failed += 1
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """ waits for all the emails to be delivered, returns the number (sent, failed) """
+        self.executor.shutdown(wait=True)
+        return self.num_sent, self.num_failed
@@ -0,0 +1,60 @@
+"""
+Benchmarks the ingest of arxiv_daemon.py offline: serves synthetic papers with a local
+fake_arxiv.py server, runs the daemon against it into a fresh temporary database, and
+reports the throughput in papers/s of the fetch, parse and store stages separately.
+e.g. to compare the parsers and the pipelined mode:
+python bench_ingest.py --num 5000 --parser feedparser
+python bench_ingest.py --num 5000 --parser etree --pipeline 1
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+
+from fake_arxiv import make_server, synthetic_entries
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Ingest benchmark')
+    parser.add_argument('-n', '--num', type=int, default=5000, help='number of papers to ingest')
+    parser.add_argument('-p', '--pipeline', type=int, default=0, help='run the daemon in its --pipeline mode')
+    parser.add_argument('--parser', type=str, default='etree', choices=['etree', 'feedparser'], help='the --parser of the daemon')
+    parser.add_argument('--latency', type=float, default=0.0, help='average seconds of latency of the fake api')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake api requests that fail')
+    parser.add_argument('--politeness', type=float, default=0.0, help='the --politeness of the daemon, 0 to not sleep between requests at all')
+    args = parser.parse_args()
+    print(args)
+
+    # start the fake api on some free port
+    server = make_server(0, synthetic_entries(args.num), args.latency, args.error_rate)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    api_url = 'http://127.0.0.1:%d/api/query' % (server.server_address[1], )
+
+    # run the daemon in a scratch directory, so it creates a fresh data/ there
+    workdir = tempfile.mkdtemp(prefix='bench_ingest')
+    os.makedirs(os.path.join(workdir, 'data'))
+    daemon = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arxiv_daemon.py')
+    cmd = [sys.executable, daemon, '--api-url', api_url, '--num', str(args.num), '--break-after', '0',
+           '--pipeline', str(args.pipeline), '--parser', args.parser, '--politeness', str(args.politeness)]
+    print(' '.join(cmd))
+    t0 = time.time()
+    proc = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+    dt = time.time() - t0
+    dbsize = os.path.getsize(os.path.join(workdir, 'data', 'papers.db')) if proc.returncode == 0 else 0
+    shutil.rmtree(workdir, ignore_errors=True)
+    server.shutdown()
+
+    # the daemon logs its per stage throughput at the very end
+    m = re.search(r'ingested .*', proc.stderr)
+    if proc.returncode != 0 or m is None:
+        print(proc.stderr[-2000:])
+        print("the daemon failed with exit code %d" % (proc.returncode, ))
+        sys.exit(1)
+    print(m.group(0))
+    print("wall time %.2fs including startup, %.1f papers/s, papers.db is %.1fMB" % (dt, args.num / dt, dbsize / 2**20))
@@ -0,0 +1,73 @@
+"""
+Checks that the fast etree parser of the arxiv api responses gives the same papers as
+the feedparser one, on responses of the api, and how much faster it is. By default it
+checks the small pages in samples/, which cover the tricky parts of the format (entities,
+multi-line titles, doi/journal_ref, old-style ids, ...). To check fresh responses too, e.g.:
+curl 'http://export.arxiv.org/api/query?search_query=cat:cs.LG&sortBy=lastUpdatedDate&start=0&max_results=100' > resp0.xml
+python check_parser.py resp*.xml
+"""
+
+import os
+import sys
+import glob
+import time
+import argparse
+
+from aslite.arxiv import parse_response_feedparser, parse_response_etree
+
+SAMPLES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples', 'api_*.xml')))
+
+# the fields that the rest of the code uses or stores
+FIELDS = ['id', '_idv', '_id', '_version', '_time', '_time_str', 'title', 'summary', 'link',
+          'updated', 'updated_parsed', 'published', 'published_parsed',
+          'arxiv_comment', 'arxiv_journal_ref', 'arxiv_doi']
+
+def compare(a, b):
+    """ returns a list of the differences between the papers a (feedparser) and b (etree) """
+    diffs = []
+    for k in FIELDS:
+        if a.get(k) != b.get(k):
+            diffs.append((k, a.get(k), b.get(k)))
+    names = lambda p: [x['name'] for x in p['authors']]
+    if names(a) != names(b):
+        diffs.append(('authors', names(a), names(b)))
+    terms = lambda p: [(t['term'], t['scheme'], t['label']) for t in p['tags']]
+    if terms(a) != terms(b):
+        diffs.append(('tags', terms(a), terms(b)))
+    return diffs
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compare the arxiv api response parsers')
+    parser.add_argument('files', nargs='*', default=SAMPLES, help='responses of the arxiv api, the pages in samples/ by default')
+    args = parser.parse_args()
+
+    npapers, nbad = 0, 0
+    tfeed, tetree = 0.0, 0.0
+    for fname in args.files:
+        with open(fname, 'rb') as f:
+            response = f.read()
+        t0 = time.time()
+        a = parse_response_feedparser(response)
+        t1 = time.time()
+        b = parse_response_etree(response)
+        t2 = time.time()
+        tfeed += t1 - t0
+        tetree += t2 - t1
+
+        if len(a) != len(b):
+            print("%s: feedparser found %d papers, etree %d" % (fname, len(a), len(b)))
+            nbad += 1
+            continue
+        for pa, pb in zip(a, b):
+            npapers += 1
+            diffs = compare(pa, pb)
+            if diffs:
+                nbad += 1
+                print("%s: %s differs" % (fname, pa['id']))
+                for k, va, vb in diffs:
+                    print("  %s: %r != %r" % (k, va, vb))
+
+    print("%d papers in %d files, %d mismatches" % (npapers, len(args.files), nbad))
+    print("feedparser %.3fs, etree %.3fs (%.1fx faster)" % (tfeed, tetree, tfeed / max(tetree, 1e-9)))
+    sys.exit(1 if nbad else 0)
@@ -2,16 +2,157 @@
 Extracts tfidf features from all paper abstracts and saves them to disk.
 """
 
+import sys
+import numbers
 import argparse
 from random import shuffle
+from multiprocessing import Pool
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
+from scipy.sparse import vstack
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 
-from aslite.db import get_papers_db, save_features
+from aslite.db import get_papers_db, get_docs_db, save_features, load_features, features_version
 
 # -----------------------------------------------------------------------------
 
+def doc_text(title, authors, summary):
+    """ the text of a paper that we featurize """
+    return ' '.join([title, summary, authors])
+
+def iter_texts(ddb, keys, batch_size=10000):
+    """ yields the texts of the papers with the given keys, in order, reading them in batches """
+    for i in range(0, len(keys), batch_size):
+        batch = keys[i:i+batch_size]
+        docs = ddb.get_many(batch)
+        for k in batch:
+            yield doc_text(*docs[k])
+
+# -----------------------------------------------------------------------------
+# multi-process version of the tfidf fit and transform for --workers > 1. the corpus is
+# split into chunks of papers, the workers count terms / vectorize their chunks and the
+# main process merges the results. the result is identical to the single process one.
+
+# every worker process opens its own handle to the docs db
+_ddb = None
+def _init_worker():
+    global _ddb
+    _ddb = get_docs_db()
+
+def _count_chunk(job):
+    """ term statistics of one chunk of papers: (terms, document frequencies, term frequencies) """
+    v, keys = job
+    # a plain counter with the exact same text analysis as the tfidf vectorizer, but no pruning
+    params = v.get_params()
+    cv = CountVectorizer(**{k: params[k] for k in ['input', 'encoding', 'decode_error', 'strip_accents',
+        'lowercase', 'preprocessor', 'tokenizer', 'analyzer', 'stop_words', 'token_pattern', 'ngram_range']})
+    try:
+        X = cv.fit_transform(iter_texts(_ddb, keys))
+    except ValueError:
+        return np.zeros(0, dtype=str), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64) # no terms at all
+    terms = np.array(cv.get_feature_names_out(), dtype=str)
+    df = np.bincount(X.indices, minlength=X.shape[1])
+    tf = np.asarray(X.sum(axis=0)).ravel()
+    return terms, df, tf
+
+def _transform_chunk(job):
+    v, keys = job
+    return v.transform(iter_texts(_ddb, keys)).astype(np.float32)
+
+def _chunks(keys, workers):
+    n = max(1, -(-len(keys) // (4 * workers))) # a few chunks per worker, for load balancing
+    return [keys[i:i+n] for i in range(0, len(keys), n)]
+
+def fit_parallel(v, keys, workers):
+    """ fits the vectorizer v on the papers with the given keys, same as v.fit() would """
+    with Pool(workers, initializer=_init_worker) as pool:
+        stats = pool.map(_count_chunk, [(v, c) for c in _chunks(keys, workers)])
+
+    # reduce: sum up the statistics of every term across all the chunks
+    terms = np.concatenate([t for t, _, _ in stats])
+    vterms, inv = np.unique(terms, return_inverse=True) # sorted, just like sklearn sorts its features
+    df = np.bincount(inv, weights=np.concatenate([d for _, d, _ in stats]), minlength=len(vterms)).astype(np.int64)
+    tf = np.bincount(inv, weights=np.concatenate([t for _, _, t in stats]), minlength=len(vterms)).astype(np.int64)
+
+    # prune the vocabulary exactly like sklearn's CountVectorizer._limit_features
+    n_doc = len(keys)
+    high = v.max_df if isinstance(v.max_df, numbers.Integral) else v.max_df * n_doc
+    low = v.min_df if isinstance(v.min_df, numbers.Integral) else v.min_df * n_doc
+    mask = (df <= high) & (df >= low)
+    if v.max_features is not None and mask.sum() > v.max_features:
+        mask_inds = (-tf[mask]).argsort()[:v.max_features]
+        new_mask = np.zeros(len(df), dtype=bool)
+        new_mask[np.where(mask)[0][mask_inds]] = True
+        mask = new_mask
+    kept = np.flatnonzero(mask)
+
+    # and compute the idf exactly like sklearn's TfidfTransformer
+    dfk = df[kept].astype(np.float64) + float(v.smooth_idf)
+    idf = np.log((n_doc + int(v.smooth_idf)) / dfk) + 1.0
+
+    v.set_params(vocabulary={t: i for i, t in enumerate(vterms[kept].tolist())})
+    v.idf_ = idf
+
+def transform_parallel(v, keys, workers):
+    """ vectorizes the papers with the given keys, same as v.transform() would """
+    with Pool(workers, initializer=_init_worker) as pool:
+        xs = pool.map(_transform_chunk, [(v, c) for c in _chunks(keys, workers)])
+    return vstack(xs, format='csr')
+
+# -----------------------------------------------------------------------------
+
+def _top_k(s, k, cix=None):
+    """ the k largest entries of every row of s, best first, and their column (or cix) indices """
+    ix = np.argpartition(-s, k - 1, axis=1)[:, :k]
+    sk = np.take_along_axis(s, ix, axis=1)
+    order = np.argsort(-sk, axis=1)
+    ix, sk = np.take_along_axis(ix, order, axis=1), np.take_along_axis(sk, order, axis=1)
+    if cix is not None:
+        ix = np.take_along_axis(cix, ix, axis=1)
+    return ix, sk
+
+def compute_knn(x, k, block_mb=256, start=0):
+    """
+    finds the top k most similar rows of every row of x (from row start on) by cosine
+    similarity (the rows are already l2 normalized so this is just a dot product). the
+    similarities are computed one block of rows at a time to keep the memory use bounded.
+    returns (n - start, k) arrays of the neighbor indices and their similarities, best first.
+    """
+    n = x.shape[0]
+    k = min(k, n - 1)
+    xt = x.T.tocsc()
+    block = max(1, block_mb * 2**20 // (4 * n)) # rows per block, at 4 bytes per similarity
+    knn_ix = np.zeros((n - start, k), dtype=np.int32)
+    knn_s = np.zeros((n - start, k), dtype=np.float32)
+    for i in range(start, n, block):
+        j = min(i + block, n)
+        s = (x[i:j] @ xt).toarray()
+        s[np.arange(j - i), np.arange(i, j)] = -np.inf # a paper is not its own neighbor
+        knn_ix[i-start:j-start], knn_s[i-start:j-start] = _top_k(s, k)
+        print("knn %d/%d" % (j, n))
+    return knn_ix, knn_s
+
+def update_knn(x, knn_ix, knn_s, block_mb=256):
+    """
+    brings the top k table that compute_knn made for the first rows of x up to date with the
+    rows that were appended to x since: the new rows get their neighbors among all the rows,
+    and the old rows only have to check the new rows against the neighbors they already have
+    """
+    n, (n_old, k) = x.shape[0], knn_ix.shape
+    new_ix, new_s = compute_knn(x, k, block_mb, start=n_old)
+    xt_new = x[n_old:].T.tocsc()
+    cix_new = np.arange(n_old, n, dtype=np.int32)
+    block = max(1, block_mb * 2**20 // (4 * (n - n_old + k)))
+    old_ix = np.zeros((n_old, k), dtype=np.int32)
+    old_s = np.zeros((n_old, k), dtype=np.float32)
+    for i in range(0, n_old, block):
+        j = min(i + block, n_old)
+        s = np.hstack([knn_s[i:j], (x[i:j] @ xt_new).toarray()])
+        cix = np.hstack([knn_ix[i:j], np.broadcast_to(cix_new, (j - i, n - n_old))])
+        old_ix[i:j], old_s[i:j] = _top_k(s, k, cix)
+    print("updated the knn of %d old papers with %d new ones" % (n_old, n - n_old))
+    return np.vstack([old_ix, new_ix]), np.vstack([old_s, new_s])
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Arxiv Computor')
@@ -19,6 +160,11 @@ if __name__ == '__main__':
     parser.add_argument('--min_df', type=int, default=5, help='min df')
     parser.add_argument('--max_df', type=float, default=0.1, help='max df')
     parser.add_argument('--max_docs', type=int, default=-1, help='maximum number of documents to use when training tfidf, or -1 to disable')
+    parser.add_argument('--knn', type=int, default=0, help='also precompute the top k most similar papers of every paper. 0 keeps the table of the existing features up to date (if they have one), -1 drops it')
+    parser.add_argument('--knn_block_mb', type=int, default=256, help='approximate memory budget in MB of one block of similarities when computing --knn')
+    parser.add_argument('--full', action='store_true', help='always refit the tfidf vectorizer on the whole corpus, instead of incrementally adding new papers')
+    parser.add_argument('--refit_frac', type=float, default=0.2, help='do a full refit anyway once the corpus has grown by this fraction since the last full refit')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to fit and transform with')
     args = parser.parse_args()
     print(args)
 
@@ -30,38 +176,115 @@ if __name__ == '__main__':
                         norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=True,
                         max_df=args.max_df, min_df=args.min_df)
 
-    pdb = get_papers_db(flag='r')
+    # we read the text of the papers from the slim docs table, not the full papers table.
+    # make sure it has all of the papers first (e.g. for a db from before it existed)
+    with get_papers_db(flag='r') as pdb, get_docs_db(flag='c', autocommit=False) as ddb:
+        nmissing = ddb.backfill(pdb)
+        if nmissing > 0:
+            print("added %d papers that were missing from the docs table" % (nmissing, ))
+    ddb = get_docs_db(flag='r')
+    all_pids = ddb.keys()
+    all_pids_set = set(all_pids)
 
-    def make_corpus(training: bool):
-        assert isinstance(training, bool)
-
-        # determine which papers we will use to build tfidf
-        if training and args.max_docs > 0 and args.max_docs < len(pdb):
+    def training_keys():
+        # determine which papers we will use to build tfidf, None meaning all of them
+        if args.max_docs > 0 and args.max_docs < len(all_pids):
             # crop to a random subset of papers
-            keys = list(pdb.keys())
+            keys = list(all_pids)
             shuffle(keys)
-            keys = keys[:args.max_docs]
+            return keys[:args.max_docs]
+        return None
+
+    def make_corpus(keys=None):
+        # yield the abstracts of the given papers, or of all papers if keys is None
+        if keys is None:
+            # simply stream through the whole docs table in order
+            for pid, title, authors, summary in ddb.iter_docs():
+                if pid in all_pids_set: # skip any papers that got added while we were running
+                    yield doc_text(title, authors, summary)
         else:
-            keys = pdb.keys()
+            yield from iter_texts(ddb, keys)
+
+    # the settings that determine the vocabulary and idf, an incremental update must not change them
+    settings = {'num': args.num, 'min_df': args.min_df, 'max_df': args.max_df, 'max_docs': args.max_docs}
+
+    # see if we can just incrementally add the new papers to the existing features instead
+    # of refitting everything: we keep the old vocabulary and idf and only vectorize new papers
+    prev = load_features() if features_version() is not None else None
+    old = None
+    if not args.full and prev is not None:
+        old = prev
+        n_fit = old.get('n_fit', 0)
+        growth = (len(all_pids) - n_fit) / max(1, n_fit)
+        if old.get('settings') != settings:
+            print("tfidf settings are different from the existing features, doing a full refit")
+            old = None
+        elif growth > args.refit_frac:
+            print("corpus grew by %.1f%% since the last full refit, doing a full refit" % (100*growth, ))
+            old = None
 
-        # yield the abstracts of the papers
-        for p in keys:
-            d = pdb[p]
-            author_str = ' '.join([a['name'] for a in d['authors']])
-            yield ' '.join([d['title'], d['summary'], author_str])
+    # the existing similar papers table is kept (and kept up to date) unless asked otherwise
+    knn = args.knn
+    if knn == 0 and prev is not None and 'knn_ix' in prev:
+        knn = prev['knn_ix'].shape[1]
+    def has_knn(features, n):
+        # does features have a table of the knn papers of its first n papers that we can build on
+        return features is not None and 'knn_ix' in features and features['knn_ix'].shape[1] == min(knn, n - 1)
 
-    print("training tfidf vectors...")
-    v.fit(make_corpus(training=True))
+    if old is not None:
+        have = set(old['pids'])
+        new_pids = [p for p in all_pids if p not in have]
+        print("incremental update: %d papers already have features, %d new" % (len(have), len(new_pids)))
+        if len(new_pids) == 0 and (knn <= 0 or has_knn(old, len(have))):
+            print("nothing to do, exitting")
+            sys.exit(0)
 
-    print("running inference...")
-    x = v.transform(make_corpus(training=False)).astype(np.float32)
+        if len(new_pids) > 0:
+            v.set_params(vocabulary=old['vocab'])
+            v.idf_ = old['idf']
+
+            print("running inference on the new papers...")
+            if args.workers > 1:
+                x_new = transform_parallel(v, new_pids, args.workers)
+            else:
+                x_new = v.transform(make_corpus(new_pids)).astype(np.float32)
+            x = vstack([old['x'], x_new], format='csr')
+        else:
+            x = old['x'] # we are only here to compute the knn
+        pids = old['pids'] + new_pids
+        vocab, idf = old['vocab'], old['idf']
+        n_fit = old['n_fit']
+    else:
+        pids = all_pids
+        if args.workers > 1:
+            print("training tfidf vectors with %d workers..." % (args.workers, ))
+            fit_parallel(v, training_keys() or all_pids, args.workers)
+            print("running inference with %d workers..." % (args.workers, ))
+            x = transform_parallel(v, pids, args.workers)
+        else:
+            print("training tfidf vectors...")
+            v.fit(make_corpus(training_keys()))
+            print("running inference...")
+            x = v.transform(make_corpus()).astype(np.float32)
+        vocab, idf = v.vocabulary_, v.idf_
+        n_fit = len(pids)
     print(x.shape)
 
-    print("saving to features to disk...")
     features = {
-        'pids': list(pdb.keys()),
+        'pids': pids,
         'x': x,
-        'vocab': v.vocabulary_,
-        'idf': v._tfidf.idf_,
+        'vocab': vocab,
+        'idf': idf,
+        'n_fit': n_fit, # size of the corpus at the last full refit
+        'settings': settings,
     }
+
+    if knn > 0 and old is not None and 'knn_ix' in old and old['knn_ix'].shape[1] == knn:
+        print("adding the %d new papers to the top %d most similar papers table..." % (x.shape[0] - len(old['pids']), knn))
+        features['knn_ix'], features['knn_s'] = update_knn(x, old['knn_ix'], old['knn_s'], args.knn_block_mb)
+    elif knn > 0:
+        print("computing the top %d most similar papers of every paper..." % (knn, ))
+        features['knn_ix'], features['knn_s'] = compute_knn(x, knn, args.knn_block_mb)
+
+    print("saving to features to disk...")
     save_features(features)
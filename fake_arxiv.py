@@ -0,0 +1,135 @@
+"""
+A local stand-in for the arxiv api (export.arxiv.org/api/query), so that we can test and
+benchmark arxiv_daemon.py offline. Serves the atom pages of either synthetic papers, or
+of the papers in responses recorded from the real api, with the same start/max_results
+paging, and optionally some latency and random errors to keep the client honest. e.g.:
+python fake_arxiv.py --port 8080 --latency 0.5 --error-rate 0.05
+python fake_arxiv.py --port 8080 --recorded samples/api_*.xml
+python arxiv_daemon.py --api-url http://localhost:8080/api/query --num 2000
+"""
+
+import re
+import time
+import random
+import argparse
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+FEED_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title type="html">ArXiv Query: %s</title>
+  <id>http://arxiv.org/api/fake</id>
+  <updated>%s</updated>
+  <opensearch:totalResults xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">%d</opensearch:totalResults>
+  <opensearch:startIndex xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">%d</opensearch:startIndex>
+  <opensearch:itemsPerPage xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">%d</opensearch:itemsPerPage>
+"""
+
+ENTRY = """  <entry>
+    <id>http://arxiv.org/abs/%(idv)s</id>
+    <updated>%(updated)s</updated>
+    <published>%(published)s</published>
+    <title>%(title)s</title>
+    <summary>%(summary)s</summary>
+%(authors)s
+    <arxiv:comment xmlns:arxiv="http://arxiv.org/schemas/atom">%(npages)d pages, %(nfigs)d figures</arxiv:comment>
+    <link href="http://arxiv.org/abs/%(idv)s" rel="alternate" type="text/html"/>
+    <link title="pdf" href="http://arxiv.org/pdf/%(idv)s" rel="related" type="application/pdf"/>
+    <arxiv:primary_category xmlns:arxiv="http://arxiv.org/schemas/atom" term="%(cat)s" scheme="http://arxiv.org/schemas/atom"/>
+    <category term="%(cat)s" scheme="http://arxiv.org/schemas/atom"/>
+  </entry>
+"""
+
+WORDS = ('we propose a novel method for learning deep neural network models that improves the state of the art '
+         'on image classification object detection segmentation language modeling translation and reinforcement '
+         'learning benchmarks using attention transformers graph convolutions diffusion generative adversarial '
+         'training self supervised contrastive objectives sparse mixture of experts and efficient inference').split()
+NAMES = ['Alice Smith', 'Bob Jones', 'Carol Li', 'Dan Brown', 'Eve Ng', 'Frank Chen', 'Grace Kim', 'Jürgen Müller']
+CATS = ['cs.CV', 'cs.LG', 'cs.CL', 'cs.AI', 'cs.NE', 'cs.RO']
+
+def synthetic_entries(num, seed=1337):
+    """ atom entries of num random papers, from the most recently updated to the oldest """
+    rng = random.Random(seed)
+    tnow = int(time.time())
+    entries = []
+    for i in range(num):
+        t = tnow - i * 300 # a paper every 5 minutes
+        fmt = lambda t: time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+        entries.append(ENTRY % {
+            'idv': '%04d.%05dv%d' % (2300 + i // 100000, i % 100000, rng.randint(1, 3)),
+            'updated': fmt(t),
+            'published': fmt(t - rng.randint(0, 30) * 86400),
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))).title(),
+            'summary': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(100, 250))),
+            'authors': '\n'.join('    <author>\n      <name>%s</name>\n    </author>' % (n, )
+                                 for n in rng.sample(NAMES, rng.randint(1, 5))),
+            'npages': rng.randint(4, 40),
+            'nfigs': rng.randint(0, 12),
+            'cat': rng.choice(CATS),
+        })
+    return entries
+
+def recorded_entries(files):
+    """ the raw atom entries of responses recorded from the real api, in order """
+    entries = []
+    for fname in files:
+        with open(fname, 'r', encoding='utf-8') as f:
+            entries.extend('  ' + e + '\n' for e in re.findall(r'<entry>.*?</entry>', f.read(), flags=re.DOTALL))
+    return entries
+
+class Handler(BaseHTTPRequestHandler):
+
+    entries = []
+    latency = 0.0
+    error_rate = 0.0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/api/query':
+            self.send_error(404)
+            return
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.error_rate:
+            self.send_error(503, 'injected error')
+            return
+
+        qs = parse_qs(url.query)
+        start = int(qs.get('start', ['0'])[0])
+        max_results = int(qs.get('max_results', ['10'])[0])
+        page = self.entries[start:start+max_results]
+        head = FEED_HEAD % (url.query.replace('&', '&amp;'), time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                            len(self.entries), start, len(page))
+        body = (head + ''.join(page) + '</feed>\n').encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/atom+xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # quiet
+
+def make_server(port, entries, latency=0.0, error_rate=0.0):
+    """ a server (not yet started) of the given entries on localhost """
+    handler = type('FakeArxivHandler', (Handler, ), {'entries': entries, 'latency': latency, 'error_rate': error_rate})
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fake arxiv api')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='port to serve on')
+    parser.add_argument('-n', '--num', type=int, default=20000, help='number of synthetic papers to serve')
+    parser.add_argument('-r', '--recorded', type=str, nargs='*', default=[], help='serve the papers of these recorded api responses instead')
+    parser.add_argument('--latency', type=float, default=0.0, help='average seconds of latency to add to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests to fail with a 503')
+    args = parser.parse_args()
+    print(args)
+
+    entries = recorded_entries(args.recorded) if args.recorded else synthetic_entries(args.num)
+    server = make_server(args.port, entries, args.latency, args.error_rate)
+    print("serving %d papers at http://127.0.0.1:%d/api/query" % (len(entries), args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
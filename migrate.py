@@ -0,0 +1,80 @@
+"""
+One-off maintenance commands that bring an existing database up to date with
+the current code, e.g. (re)building derived tables and indexes from the papers.
+Usage: python migrate.py <command>, see --help for the list of commands.
+"""
+
+import time
+import sqlite3
+import argparse
+
+from aslite.db import get_papers_db, get_metas_db, get_docs_db, get_tags_db
+from aslite.db import train_papers_dict, zstandard, PAPERS_DB_FILE
+
+# -----------------------------------------------------------------------------
+
+def migrate_search():
+    """ (re)build the docs table and its full-text search index from all papers """
+    pdb = get_papers_db()
+    with get_docs_db(flag='c', autocommit=False) as ddb:
+        for i, (pid, p) in enumerate(pdb.items()):
+            ddb[pid] = p
+            if i % 10000 == 0:
+                print("indexed %d/%d papers" % (i, len(pdb)))
+        ddb.rebuild()
+    pdb.close()
+
+def migrate_metas():
+    """ move the metas from the old sqlitedict table into the indexed metas table """
+    # note that opening the metas db for writing does the actual work, if needed
+    with get_metas_db(flag='c') as mdb:
+        print("metas table has %d papers" % (len(mdb), ))
+
+def migrate_tags():
+    """ move the tags from the old sqlitedict table of a pickled library per user into the user_tags table """
+    # note that opening the tags db for writing does the actual work, if needed
+    with get_tags_db(flag='c') as tdb:
+        print("user_tags table has tags of %d users" % (len(tdb), ))
+
+def migrate_papers():
+    """ rewrite all papers into the compact record format, with a freshly trained zstd dictionary """
+    if zstandard is not None:
+        with get_papers_db() as pdb:
+            dict_id = train_papers_dict(pdb)
+        print("trained zstd dictionary %d" % (dict_id, ))
+    else:
+        print("zstandard is not installed, papers will be compressed with zlib instead")
+
+    # (re)opening the db picks up the new dictionary for all the writes below
+    with get_papers_db(flag='c', autocommit=False) as pdb:
+        keys = list(pdb.keys())
+        for i in range(0, len(keys), 10000):
+            for pid in keys[i:i+10000]:
+                pdb[pid] = pdb[pid] # decodes whatever format the row has, encodes the new one
+            pdb.commit()
+            print("rewrote %d/%d papers" % (min(i + 10000, len(keys)), len(keys)))
+
+    # give the space of the old, larger rows back to the filesystem
+    conn = sqlite3.connect(PAPERS_DB_FILE)
+    conn.execute("VACUUM")
+    conn.close()
+
+# -----------------------------------------------------------------------------
+
+COMMANDS = {
+    'search': migrate_search,
+    'metas': migrate_metas,
+    'papers': migrate_papers,
+    'tags': migrate_tags,
+}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Database migrations')
+    parser.add_argument('command', choices=list(COMMANDS.keys()), help='what to migrate')
+    args = parser.parse_args()
+    print(args)
+
+    t0 = time.time()
+    COMMANDS[args.command]()
+    print("done in %.2fs" % (time.time() - t0, ))
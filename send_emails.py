@@ -7,24 +7,28 @@ the recommendations may become more complex in the future, so this is ok for now
 
 You'll notice that the file sendgrid_api_key.txt is not in the repo, you'd have
 to manually register with sendgrid yourself, get an API key and put it in the file.
+Alternatively send through any smtp server with --transport smtp, see aslite/mailer.py.
+If a run crashes, just run it again the same day: it picks up where it left off.
 """
 
 import os
 import time
 import random
+import hashlib
 import argparse
+from multiprocessing import Pool
 
 import numpy as np
 from sklearn import svm
 
-import sendgrid
-from sendgrid.helpers.mail import Email, To, Content, Mail
-
-from aslite.db import load_features
+from aslite.db import load_features, features_version
 from aslite.db import get_tags_db
 from aslite.db import get_metas_db
-from aslite.db import get_papers_db
+from aslite.db import get_docs_db
 from aslite.db import get_email_db
+from aslite.db import get_outbox_db
+from aslite.db import get_sent_db
+from aslite.mailer import Mailer, get_transport
 
 # -----------------------------------------------------------------------------
 # the html template for the email
@@ -77,20 +81,48 @@ To stop these emails remove your email in your <a href="https://arxiv-sanity-lit
 </html>
 """
 
+# -----------------------------------------------------------------------------
+# the recommendations are computed by a pool of --workers processes, which each open the
+# (memory mapped) features themselves, so they all share a single copy of them in RAM
+
+def init_worker(tnow, time_delta):
+    global features, ptoi, window
+    # the tfidf features, as a (shared) memory map
+    features = load_features()
+    ptoi = {p:i for i, p in enumerate(features['pids'])}
+    # the rows of the papers that are recent enough to recommend, the same for all users
+    deltat = time_delta*60*60*24 # allowed time delta in seconds
+    with get_metas_db() as mdb:
+        recent = [pid for pid, t in mdb.latest(tmin=tnow - deltat)]
+    window = np.sort(np.array([ptoi[p] for p in recent if p in ptoi], dtype=np.int64))
+
+def tags_hash(tags):
+    """ a fingerprint of the tags of a user, that changes if they tag or untag anything """
+    return hashlib.md5(repr(sorted((t, sorted(pids)) for t, pids in tags.items())).encode('utf-8')).hexdigest()
+
+def recommend(job):
+    """ computes the recommendations of one user, returns (user, tags, recommendations) """
+    user, tags, num_recommendations, exclude = job
+    return user, tags, calculate_recommendation(tags, num_recommendations, exclude)
+
 # -----------------------------------------------------------------------------
 
 def calculate_recommendation(
     tags,
-    time_delta = 3, # how recent papers are we recommending? in days
+    num_recommendations = 20, # how many papers we will end up showing
+    exclude = (), # papers that we already sent to the user before
     ):
 
-    # a bit of preprocessing
-    x, pids = features['x'], features['pids']
+    x, itop = features['x'], features['pids']
     n, d = x.shape
-    ptoi, itop = {}, {}
-    for i, p in enumerate(pids):
-        ptoi[p] = i
-        itop[i] = p
+
+    # the papers we could recommend: in the recent window, not already tagged by the user, and not sent before
+    have = set(ptoi[p] for p in set().union(*tags.values(), exclude) if p in ptoi)
+    candidates = np.array([i for i in window if i not in have], dtype=np.int64)
+    k = min(num_recommendations, len(candidates))
+    if k == 0:
+        return {}, {}, 0 # nothing new to recommend, don't bother training anything
+    xc = x[candidates] # we only ever score these, no need to score the whole archive
 
     # loop over all the tags
     all_pids, all_scores = {}, {}
@@ -104,34 +136,27 @@ def calculate_recommendation(
         for pid in pids:
             y[ptoi[pid]] = 1.0
 
-        # classify
+        # classify, training on all the papers but scoring just the candidates
         clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=0.01)
         clf.fit(x, y)
-        s = clf.decision_function(x)
-        sortix = np.argsort(-s)
-        pids = [itop[ix] for ix in sortix]
-        scores = [100*float(s[ix]) for ix in sortix]
 
-        # filter by time to only recent papers
-        deltat = time_delta*60*60*24 # allowed time delta in seconds
-        keep = [i for i,pid in enumerate(pids) if (tnow - metas[pid]['_time']) < deltat]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
-
-        # finally exclude the papers we already have tagged
-        have = set().union(*tags.values())
-        keep = [i for i,pid in enumerate(pids) if pid not in have]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
+        # select just the top k of the candidates, we never show more than that anyway
+        # (even after merging across tags, the top k overall are in the top k of some tag)
+        sc = clf.decision_function(xc)
+        topix = np.argpartition(-sc, k - 1)[:k]
+        topix = topix[np.argsort(-sc[topix])]
+        pids = [itop[candidates[ix]] for ix in topix]
+        scores = [100*float(sc[ix]) for ix in topix]
 
         # store results
         all_pids[tag] = pids
         all_scores[tag] = scores
 
-
-    return all_pids, all_scores
+    return all_pids, all_scores, len(candidates)
 
 # -----------------------------------------------------------------------------
 
-def render_recommendations(user, tags, tag_pids, tag_scores):
+def render_recommendations(user, tags, tag_pids, tag_scores, num_candidates):
     # render the paper recommendations into the html template
 
     # first we are going to merge all of the papers / scores together using a MAX
@@ -150,11 +175,10 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
     # now render the html for each individual recommendation
     parts = []
     n = min(len(scores), args.num_recommendations)
+    docs = ddb.get_many(pids[:n]) # fetch the text of all the papers we show in one go
     for score, pid in zip(scores[:n], pids[:n]):
-        p = pdb[pid]
-        authors = ', '.join(a['name'] for a in p['authors'])
+        title, authors, summary = docs[pid]
         # crop the abstract
-        summary = p['summary']
         summary = summary[:min(500, len(summary))]
         if len(summary) == 500:
             summary += '...'
@@ -170,7 +194,7 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
 <div class="u">%s</div>
 </td>
 </tr>
-""" % (score, url, p['title'], max_source_tag[pid], authors, summary)
+""" % (score, url, title, max_source_tag[pid], authors, summary)
         )
 
     # render the final html
@@ -184,7 +208,7 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
     num_papers_tagged = len(set().union(*tags.values()))
     tags_str = ', '.join(['"%s" (%d)' % (t, len(pids)) for t, pids in tags.items()])
     stats = f"We took the {num_papers_tagged} papers across your {len(tags)} tags ({tags_str}) and \
-              ranked {len(pids)} papers that showed up on arxiv over the last \
+              ranked {num_candidates} papers that showed up on arxiv over the last \
               {args.time_delta} days using tfidf SVMs over paper abstracts. Below are the \
               top {args.num_recommendations} papers. Remember that the more you tag, \
               the better this gets:"
@@ -193,30 +217,7 @@ def render_recommendations(user, tags, tag_pids, tag_scores):
     # render the account
     out = out.replace('__ACCOUNT__', user)
 
-    return out
-
-# -----------------------------------------------------------------------------
-# send the actual html via sendgrid
-
-def send_email(to, html):
-
-    # init the api
-    assert os.path.isfile('sendgrid_api_key.txt')
-    api_key = open('sendgrid_api_key.txt', 'r').read().strip()
-    sg = sendgrid.SendGridAPIClient(api_key=api_key)
-
-    # construct the email
-    from_email = Email("admin@arxiv-sanity-lite.com")
-    to_email = To(to)
-    subject = tnow_str + " Arxiv Sanity Lite recommendations"
-    content = Content("text/html", html)
-    mail = Mail(from_email, to_email, subject, content)
-
-    # hope for the best :)
-    if not args.dry_run:
-        response = sg.client.mail.send.post(request_body=mail.get())
-        print(response.status_code)
-        pass
+    return out, pids[:n]
 
 # -----------------------------------------------------------------------------
 
@@ -228,6 +229,12 @@ if __name__ == "__main__":
     parser.add_argument('-d', '--dry-run', type=int, default=0, help='if set to 1 do not actually send the emails')
     parser.add_argument('-u', '--user', type=str, default='', help='restrict recommendations only to a single given user (used for debugging)')
     parser.add_argument('-m', '--min-papers', type=int, default=1, help='user must have at least this many papers for us to send recommendations')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of processes to compute the recommendations with')
+    parser.add_argument('--transport', type=str, default='sendgrid', choices=['sendgrid', 'smtp', 'file', 'http'], help='how to send the emails')
+    parser.add_argument('--sink', type=str, default='', help='directory (for --transport file) or url (for --transport http) to send the emails to, for testing')
+    parser.add_argument('--smtp-host', type=str, default='localhost', help='smtp server for --transport smtp')
+    parser.add_argument('--smtp-port', type=int, default=587, help='smtp port for --transport smtp')
+    parser.add_argument('--send-workers', type=int, default=8, help='up to how many emails to send concurrently')
     args = parser.parse_args()
     print(args)
 
@@ -236,66 +243,135 @@ if __name__ == "__main__":
 
     # read entire db simply into RAM
     with get_tags_db() as tags_db:
-        tags = {k:v for k,v in tags_db.items()}
-
-    # read entire db simply into RAM
-    with get_metas_db() as mdb:
-        metas = {k:v for k,v in mdb.items()}
+        users = list(tags_db.items())
 
     # read entire db simply into RAM
     with get_email_db() as edb:
         emails = {k:v for k,v in edb.items()}
 
-    # read tfidf features into RAM
-    features = load_features()
+    # keep the text of the papers as only a handle, since this can be larger
+    ddb = get_docs_db()
 
-    # keep the papers as only a handle, since this can be larger
-    pdb = get_papers_db()
+    # what we sent to every user last time, so we can skip the users for whom nothing changed since,
+    # and never send anyone the same paper twice. we only need to remember the papers that are still
+    # recent enough to be recommended again
+    sdb = get_sent_db(flag='c')
+    ledger = {k:v for k,v in sdb.items()}
+    fversion = features_version()
+    with get_metas_db() as mdb:
+        recent = set(pid for pid, t in mdb.latest(tmin=tnow - args.time_delta*60*60*24))
+
+    def ledger_entry(user, tags, shown):
+        entry = ledger.get(user, {'pids': set()})
+        return {'tags_hash': tags_hash(tags), 'features_version': fversion, 'pids': (entry['pids'] & recent) | set(shown)}
+
+    def record_sent(key, meta):
+        # called by the mailer once an email actually went out, which the ledger must not get ahead of
+        if meta is not None:
+            sdb[meta['user']] = meta['ledger']
+
+    # start the workers that calculate the recommendations (before the mailer starts any threads,
+    # which don't mix well with forking), or just set up this process to do it if there's one
+    if args.workers > 1:
+        pool = Pool(args.workers, initializer=init_worker, initargs=(tnow, args.time_delta))
+    else:
+        init_worker(tnow, args.time_delta)
+
+    # every email goes through the outbox, under a key that is unique to the day and the user. on
+    # startup we finish sending what an earlier (crashed) run of today left in there, and forget
+    # about the emails of the previous days
+    run = time.strftime('%Y-%m-%d', time.localtime(tnow))
+    mailer = None
+    if not args.dry_run:
+        outbox = get_outbox_db(flag='c')
+        for key in list(outbox.keys()):
+            if not key.startswith(run + '/'):
+                del outbox[key]
+        transport = get_transport(args.transport, args.sink, args.smtp_host, args.smtp_port)
+        mailer = Mailer(transport, outbox, workers=args.send_workers, on_sent=record_sent)
+        mailer.resume()
+
+    def jobs():
+        # yields the users that we should send recommendations to
+        for user, tags in users:
+
+            # verify that we have an email for this user
+            email = emails.get(user, None)
+            if not email:
+                print("skipping user %s, no email" % (user, ))
+                continue
+            if args.user and user != args.user:
+                print("skipping user %s, not %s" % (user, args.user))
+                continue
+            if mailer is not None and run + '/' + user in outbox:
+                # already sent, or resume() is sending it
+                print("skipping user %s, their email of today is already in the outbox" % (user, ))
+                continue
+
+            # verify that we have at least one positive example...
+            num_papers_tagged = len(set().union(*tags.values()))
+            if num_papers_tagged < args.min_papers:
+                print("skipping user %s, only has %d papers tagged" % (user, num_papers_tagged))
+                continue
+
+            # insert a fake entry in tags for the special "all" tag, which is the union of all papers
+            # tags['all'] = set().union(*tags.values())
+
+            # nothing to do if neither the tags nor the papers changed since the last email
+            entry = ledger.get(user)
+            if entry is not None and entry['tags_hash'] == tags_hash(tags) and entry['features_version'] == fversion:
+                print("skipping user %s, nothing changed since their last email" % (user, ))
+                continue
+
+            exclude = entry['pids'] if entry is not None else set()
+            yield user, tags, args.num_recommendations, exclude
+
+    # calculate the recommendations, in parallel if asked to. imap hands back the
+    # results in order, so the rendering and sending below happens just the same
+    results = pool.imap(recommend, jobs()) if args.workers > 1 else map(recommend, jobs())
 
     # iterate all users, create recommendations, send emails
     num_sent = 0
-    for user, tags in tags.items():
-
-        # verify that we have an email for this user
-        email = emails.get(user, None)
-        if not email:
-            print("skipping user %s, no email" % (user, ))
-            continue
-        if args.user and user != args.user:
-            print("skipping user %s, not %s" % (user, args.user))
-            continue
-
-        # verify that we have at least one positive example...
-        num_papers_tagged = len(set().union(*tags.values()))
-        if num_papers_tagged < args.min_papers:
-            print("skipping user %s, only has %d papers tagged" % (user, num_papers_tagged))
-            continue
+    for user, tags, (pids, scores, num_candidates) in results:
 
-        # insert a fake entry in tags for the special "all" tag, which is the union of all papers
-        # tags['all'] = set().union(*tags.values())
-
-        # calculate the recommendations
-        pids, scores = calculate_recommendation(tags, time_delta=args.time_delta)
+        email = emails[user]
         if all(len(lst) == 0 for tag, lst in pids.items()):
             print("skipping user %s, no recommendations were produced" % (user, ))
+            if not args.dry_run:
+                sdb[user] = ledger_entry(user, tags, [])
             continue
 
         # render the html
         print("rendering top %d recommendations into a report for %s..." % (args.num_recommendations, user))
-        html = render_recommendations(user, tags, pids, scores)
+        html, shown = render_recommendations(user, tags, pids, scores, num_candidates)
         # temporarily for debugging write recommendations to disk for manual inspection
         if os.path.isdir('recco'):
             with open('recco/%s.html' % (user, ), 'w') as f:
                 f.write(html)
 
-        # actually send the email
-        print("sending email...")
-        send_email(email, html)
+        # actually send the email, in the background
+        if mailer is not None:
+            print("sending email...")
+            subject = tnow_str + " Arxiv Sanity Lite recommendations"
+            meta = {'user': user, 'ledger': ledger_entry(user, tags, shown)}
+            mailer.submit(run + '/' + user, email, subject, html, meta)
         num_sent += 1
 
         # zzz?
         # time.sleep(1 + random.uniform(0, 2))
 
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+
+    # wait for the last emails to go out
+    if mailer is not None:
+        num_sent, num_failed = mailer.close()
+        if num_failed:
+            print("failed to send %d emails, run again to retry them" % (num_failed, ))
+
+    sdb.close()
+
     print("done.")
     print("sent %d emails" % (num_sent, ))
 
@@ -10,7 +10,11 @@ ideas:
 import os
 import re
 import time
+import secrets
+import threading
 from random import shuffle
+from itertools import islice
+from collections import OrderedDict
 
 import numpy as np
 from sklearn import svm
@@ -20,8 +24,9 @@ from flask import render_template
 from flask import g # global session-level object
 from flask import session
 
-from aslite.db import get_papers_db, get_metas_db, get_tags_db, get_last_active_db, get_email_db
-from aslite.db import load_features
+from aslite.db import get_papers_db, get_metas_db, get_docs_db, get_tags_db, get_last_active_db, get_email_db
+from aslite.db import load_features, features_version, papers_version
+from aslite.db import load_thumbs, thumbs_version
 
 # -----------------------------------------------------------------------------
 # inits and globals
@@ -40,6 +45,82 @@ else:
     sk = 'devkey'
 app.secret_key = sk
 
+# -----------------------------------------------------------------------------
+# the tfidf features are large and slow to unpickle, so each worker process keeps
+# one loaded copy around, and swaps in a new one whenever compute.py writes new features
+
+_features = None
+_features_lock = threading.Lock()
+
+def get_features():
+    global _features
+    version = features_version()
+    features = _features
+    if features is None or features['version'] != version:
+        with _features_lock:
+            # another thread may have already reloaded while we waited for the lock
+            if _features is None or _features['version'] != version:
+                features = load_features()
+                features['version'] = version
+                # precompute the pid -> row and index -> word lookups once
+                features['ptoi'] = {p:i for i, p in enumerate(features['pids'])}
+                features['itop'] = np.array(features['pids'], dtype=object)
+                ivocab = np.empty(len(features['vocab']), dtype=object)
+                for k, v in features['vocab'].items():
+                    ivocab[v] = k
+                features['ivocab'] = ivocab
+                _features = features # a single reference swap, so readers see either old or new
+            features = _features
+    return features
+
+# similarly, each worker keeps a columnar snapshot of the paper metadata around, so that
+# filtering by time etc. are vectorized numpy ops instead of reading and looping over all
+# of the metas. row i of the snapshot is also row i of the features (if it has features)
+
+_corpus = None
+_corpus_lock = threading.Lock()
+
+def get_corpus():
+    global _corpus
+    version = (papers_version(), features_version())
+    corpus = _corpus
+    if corpus is None or corpus['version'] != version:
+        with _corpus_lock:
+            if _corpus is None or _corpus['version'] != version:
+                with get_metas_db() as mdb:
+                    mpids, mtimes = mdb.columns()
+                ptime = dict(zip(mpids, mtimes))
+                # papers with features first and in the same order, then the ones without
+                fpids = get_features()['pids'] if version[1] is not None else []
+                fset = set(fpids)
+                pids = list(fpids) + [p for p in mpids if p not in fset]
+                _corpus = {
+                    'version': version,
+                    'pids': np.array(pids, dtype=object),
+                    'times': np.array([ptime.get(p, -np.inf) for p in pids], dtype=np.float64),
+                    'ptoi': {p:i for i, p in enumerate(pids)},
+                    'nx': len(fpids), # number of rows that have features
+                }
+            corpus = _corpus
+    return corpus
+
+# and the set of papers that have a thumbnail, from the manifest that thumb_daemon.py
+# keeps, which we load again only when it gets rewritten
+
+_thumbs = None
+_thumbs_lock = threading.Lock()
+
+def get_thumbs():
+    global _thumbs
+    version = thumbs_version()
+    thumbs = _thumbs
+    if thumbs is None or thumbs['version'] != version:
+        with _thumbs_lock:
+            if _thumbs is None or _thumbs['version'] != version:
+                _thumbs = {'version': version, 'pids': set(load_thumbs())}
+            thumbs = _thumbs
+    return thumbs['pids']
+
 # -----------------------------------------------------------------------------
 # globals that manage the (lazy) loading of various state for a request
 
@@ -48,10 +129,20 @@ def get_tags():
         return {}
     if not hasattr(g, '_tags'):
         with get_tags_db() as tags_db:
-            tags_dict = tags_db[g.user] if g.user in tags_db else {}
+            tags_dict = tags_db.get(g.user, {})
         g._tags = tags_dict
     return g._tags
 
+def get_ptags():
+    # the tags of the user inverted to pid -> [tags], so rendering a paper doesn't scan all the tags
+    if not hasattr(g, '_ptags'):
+        ptags = {}
+        for t, pids in get_tags().items():
+            for pid in pids:
+                ptags.setdefault(pid, []).append(t)
+        g._ptags = ptags
+    return g._ptags
+
 def get_papers():
     if not hasattr(g, '_pdb'):
         g._pdb = get_papers_db()
@@ -62,6 +153,11 @@ def get_metas():
         g._mdb = get_metas_db()
     return g._mdb
 
+def get_docs():
+    if not hasattr(g, '_ddb'):
+        g._ddb = get_docs_db()
+    return g._ddb
+
 @app.before_request
 def before_request():
     g.user = session.get('user', None)
@@ -79,59 +175,146 @@ def close_connection(error=None):
         g._pdb.close()
     if hasattr(g, '_mdb'):
         g._mdb.close()
+    if hasattr(g, '_ddb'):
+        g._ddb.close()
 
 # -----------------------------------------------------------------------------
 # ranking utilities for completing the search/rank/filter requests
 
-def render_pid(pid):
-    # render a single paper with just the information we need for the UI
+def render_pids(pids):
+    # render a page of papers with just the information we need for the UI
     pdb = get_papers()
-    tags = get_tags()
-    thumb_path = 'static/thumb/' + pid + '.jpg'
-    thumb_url = thumb_path if os.path.isfile(thumb_path) else ''
-    d = pdb[pid]
-    return dict(
-        weight = 0.0,
-        id = d['_id'],
-        title = d['title'],
-        time = d['_time_str'],
-        authors = ', '.join(a['name'] for a in d['authors']),
-        tags = ', '.join(t['term'] for t in d['tags']),
-        utags = [t for t, pids in tags.items() if pid in pids],
-        summary = d['summary'],
-        thumb_url = thumb_url,
-    )
+    ptags = get_ptags()
+    thumbs = get_thumbs()
+    papers = pdb.get_many(pids) # all the papers of the page in one go
+    out = []
+    for pid in pids:
+        d = papers[pid]
+        out.append(dict(
+            weight = 0.0,
+            id = d['_id'],
+            title = d['title'],
+            time = d['_time_str'],
+            authors = ', '.join(a['name'] for a in d['authors']),
+            tags = ', '.join(t['term'] for t in d['tags']),
+            utags = ptags.get(pid, []),
+            summary = d['summary'],
+            thumb_url = 'static/thumb/' + pid + '.jpg' if pid in thumbs else '',
+        ))
+    return out
+
+def render_pid(pid):
+    # render a single paper
+    return render_pids([pid])[0]
+
+def filter_mask(time_filter: str = '', skip_have: bool = False):
+    # boolean mask over the rows of the corpus, of the papers that pass the given filters
+    corpus = get_corpus()
+    mask = np.ones(len(corpus['pids']), dtype=bool)
+    if time_filter:
+        tnow = time.time()
+        deltat = int(time_filter)*60*60*24 # allowed time delta in seconds
+        mask &= corpus['times'] > tnow - deltat
+    if skip_have:
+        ptoi = corpus['ptoi']
+        tags = get_tags()
+        have = set().union(*tags.values())
+        mask[[ptoi[pid] for pid in have if pid in ptoi]] = False
+    return mask
 
 def random_rank():
-    mdb = get_metas()
-    pids = list(mdb.keys())
+    corpus = get_corpus()
+    pids = corpus['pids'].tolist()
     shuffle(pids)
     scores = [0 for _ in pids]
     return pids, scores
 
-def time_rank():
+def time_rank(start: int = 0, num: int = None, time_filter: str = '', skip_have: bool = False):
+    # reads the papers from most to least recent straight off the time index of the metas
+    # table, and only the page [start, start+num) of them if num is given
     mdb = get_metas()
-    ms = sorted(mdb.items(), key=lambda kv: kv[1]['_time'], reverse=True)
     tnow = time.time()
-    pids = [k for k, v in ms]
-    scores = [(tnow - v['_time'])/60/60/24 for k, v in ms] # time delta in days
+    tmin = tnow - int(time_filter)*60*60*24 if time_filter else None
+    stop = None if num is None else start + num
+    if skip_have:
+        # walk the index, skipping over the papers we already have, until the page is full
+        tags = get_tags()
+        have = set().union(*tags.values())
+        ms = islice((m for m in mdb.latest(tmin) if m[0] not in have), start, stop)
+    else:
+        ms = mdb.latest(tmin, offset=start, limit=-1 if num is None else num)
+    ms = list(ms)
+    pids = [k for k, t in ms]
+    scores = [(tnow - t)/60/60/24 for k, t in ms] # time delta in days
     return pids, scores
 
-def svm_rank(tags: str = '', pid: str = '', C: float = 0.01):
+class Ranking:
+    """
+    A ranked list of papers whose order is only materialized as far as it is needed.
+    The first pages just need a partial top-k selection of the scores, and paging
+    deeper extends it. Rankings that are already sorted are simply wrapped as is.
+    """
+
+    def __init__(self, pids, scores, presorted=False):
+        self.pids = np.asarray(pids, dtype=object)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self.order = np.arange(len(self.scores)) if presorted else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.scores)
+
+    def page(self, start, end):
+        """ returns the pids and scores of the papers ranked [start, end) """
+        end = min(end, len(self))
+        if end > len(self.order):
+            self._extend(end)
+        ix = self.order[start:end]
+        return self.pids[ix].tolist(), self.scores[ix].tolist()
+
+    def _extend(self, k):
+        # at least double what we have, and once we need a good chunk of it just sort it all
+        n = len(self)
+        k = min(n, max(k, 2*len(self.order)))
+        if k > n // 4:
+            self.order = np.argsort(-self.scores, kind='stable')
+        else:
+            ix = np.argpartition(-self.scores, k - 1)[:k]
+            self.order = ix[np.argsort(-self.scores[ix], kind='stable')]
+
+def knn_rank(pid: str, mask=None):
+    """ the most similar papers to pid from the table precomputed by compute.py --knn """
+    features = get_features()
+    ptoi = features['ptoi']
+    if pid not in ptoi:
+        return Ranking([], []), []
+    ix = ptoi[pid]
+
+    # the paper itself is always the top result, followed by its neighbors
+    rows = np.concatenate([[ix], features['knn_ix'][ix]])
+    scores = 100 * np.concatenate([[1.0], features['knn_s'][ix]])
+    if mask is not None:
+        keep = mask[rows]
+        rows, scores = rows[keep], scores[keep]
+
+    return Ranking(features['itop'][rows], scores, presorted=True), [] # no svm, so no weights to show either
+
+def svm_rank(tags: str = '', pid: str = '', C: float = 0.01, exact: bool = False, mask=None):
 
     # tag can be one tag or a few comma-separated tags or 'all' for all tags we have in db
     # pid can be a specific paper id to set as positive for a kind of nearest neighbor search
+    # mask can be a boolean mask over the rows of the corpus of the papers that we want ranked
     if not (tags or pid):
-        return [], [], []
+        return Ranking([], []), []
 
-    # load all of the features
-    features = load_features()
-    x, pids = features['x'], features['pids']
+    # fetch all of the features
+    features = get_features()
+    x, itop, ptoi = features['x'], features['itop'], features['ptoi']
     n, d = x.shape
-    ptoi, itop = {}, {}
-    for i, p in enumerate(pids):
-        ptoi[p] = i
-        itop[i] = p
+
+    # for a single paper, serve from the precomputed nearest neighbors if we have them
+    # (unless asked for the exact svm), which is a lot faster than training an svm
+    if pid and not exact and 'knn_ix' in features:
+        return knn_rank(pid, mask)
 
     # construct the positive set
     y = np.zeros(n, dtype=np.float32)
@@ -146,18 +329,23 @@ def svm_rank(tags: str = '', pid: str = '', C: float = 0.01):
                     y[ptoi[pid]] = 1.0
 
     if y.sum() == 0:
-        return [], [], [] # there are no positives?
+        return Ranking([], []), [] # there are no positives?
 
     # classify
     clf = svm.LinearSVC(class_weight='balanced', verbose=False, max_iter=10000, tol=1e-6, C=C)
     clf.fit(x, y)
     s = clf.decision_function(x)
-    sortix = np.argsort(-s)
-    pids = [itop[ix] for ix in sortix]
-    scores = [100*float(s[ix]) for ix in sortix]
+
+    # rank only the papers that pass the filters, and leave the sorting to the Ranking,
+    # which only sorts as much as is needed for the pages that are actually requested
+    if mask is not None:
+        keep = np.flatnonzero(mask[:n])
+        ranking = Ranking(itop[keep], 100*s[keep])
+    else:
+        ranking = Ranking(itop, 100*s)
 
     # get the words that score most positively and most negatively for the svm
-    ivocab = {v:k for k,v in features['vocab'].items()} # index to word mapping
+    ivocab = features['ivocab'] # index to word mapping
     weights = clf.coef_[0] # (n_features,) weights of the trained svm
     sortix = np.argsort(-weights)
     words = []
@@ -167,22 +355,34 @@ def svm_rank(tags: str = '', pid: str = '', C: float = 0.01):
             'weight': weights[ix],
         })
 
-    return pids, scores, words
+    return ranking, words
 
 def search_rank(q: str = ''):
     if not q:
         return [], [] # no query? no results
     qs = q.lower().strip().split() # split query by spaces and lowercase
 
-    pdb = get_papers()
+    # the full-text index narrows things down to the candidate papers that could
+    # possibly match, then we score just those with the same weighting as always
+    # until the index has all of the papers though, only a full scan finds all the results
+    ddb = get_docs()
+    nmissing = ddb.num_missing()
+    if nmissing == 0:
+        candidates = ddb.search(qs)
+    else:
+        print("WARNING: search index is missing %s papers, falling back to a full scan. run `python migrate.py search`" % (nmissing, ))
+        pdb = get_papers()
+        candidates = ((pid, p['title'], ', '.join(a['name'] for a in p['authors']), p['summary'])
+                      for pid, p in pdb.items())
+
     match = lambda s: sum(min(3, s.lower().count(qp)) for qp in qs)
     matchu = lambda s: sum(int(s.lower().count(qp) > 0) for qp in qs)
     pairs = []
-    for pid, p in pdb.items():
+    for pid, title, authors, summary in candidates:
         score = 0.0
-        score += 10.0 * matchu(' '.join([a['name'] for a in p['authors']]))
-        score += 20.0 * matchu(p['title'])
-        score += 1.0 * match(p['summary'])
+        score += 10.0 * matchu(authors)
+        score += 20.0 * matchu(title)
+        score += 1.0 * match(summary)
         if score > 0:
             pairs.append((score, pid))
 
@@ -191,6 +391,97 @@ def search_rank(q: str = ''):
     scores = [p[0] for p in pairs]
     return pids, scores
 
+# a small per-process LRU cache of full rankings, so that paging through the results
+# (especially of the expensive svm ranks) doesn't redo all of the work for every page
+
+RANK_CACHE_SIZE = 64 # max number of rankings to keep around
+RANK_CACHE_TTL = 10*60 # seconds after which a cached ranking is considered stale
+
+_rank_cache = OrderedDict() # key -> entry, from least to most recently used
+_rank_cache_lock = threading.Lock()
+
+def rank_cache_key(opt_rank, opt_q, opt_tags, opt_pid, opt_time_filter, opt_skip_have, C, opt_exact):
+    # everything that a ranking depends on, including the versions of the features and tags
+    tags = get_tags()
+    tags_version = hash(frozenset((t, frozenset(pids)) for t, pids in tags.items()))
+    return (g.user, opt_rank, opt_q, opt_tags, opt_pid, opt_time_filter, opt_skip_have, C, opt_exact,
+            features_version(), tags_version)
+
+def rank_cache_get(key, cursor=''):
+    """
+    fetch a cached ranking. a fresh request only gets it if the papers db hasn't changed
+    since, but a request that carries the ranking's cursor (i.e. the user is paging through
+    it) keeps getting the same ranking until it expires, so the pages stay consistent.
+    a random ranking is only ever reused for paging, every fresh request gets a new shuffle
+    """
+    with _rank_cache_lock:
+        entry = _rank_cache.get(key)
+        if entry is None:
+            return None
+        expired = time.time() - entry['time'] > RANK_CACHE_TTL
+        fresh = entry['cursor'] != cursor
+        outdated = fresh and (key[1] == 'random' or entry['papers_version'] != papers_version())
+        if expired or outdated:
+            del _rank_cache[key]
+            return None
+        _rank_cache.move_to_end(key)
+        return entry
+
+def rank_cache_put(key, ranking, words):
+    entry = {
+        'cursor': secrets.token_urlsafe(8),
+        'time': time.time(),
+        'papers_version': papers_version(),
+        'ranking': ranking,
+        'words': words,
+    }
+    with _rank_cache_lock:
+        _rank_cache[key] = entry
+        _rank_cache.move_to_end(key)
+        while len(_rank_cache) > RANK_CACHE_SIZE:
+            _rank_cache.popitem(last=False)
+    return entry
+
+def rank_cache_drop_user(user):
+    """ forget all cached rankings of a user, e.g. because their tags changed """
+    with _rank_cache_lock:
+        for key in [k for k in _rank_cache if k[0] == user]:
+            del _rank_cache[key]
+
+def rank_papers(opt_rank, opt_q, opt_tags, opt_pid, opt_time_filter, opt_skip_have, C, opt_exact):
+    """ rank all papers by the given settings, then filter them. returns a Ranking and the svm words """
+
+    # the papers that pass the filters, as a mask over the rows of the corpus
+    filtered = bool(opt_time_filter) or opt_skip_have == 'yes'
+    mask = filter_mask(opt_time_filter, opt_skip_have == 'yes') if filtered else None
+
+    # the svm ranks apply the filters themselves, before they select the top papers
+    if opt_rank == 'tags':
+        return svm_rank(tags=opt_tags, C=C, mask=mask)
+    elif opt_rank == 'pid':
+        return svm_rank(pid=opt_pid, C=C, exact=(opt_exact == 'yes'), mask=mask)
+
+    # rank papers: by search, by time, by random
+    if opt_rank == 'search':
+        pids, scores = search_rank(q=opt_q)
+    elif opt_rank == 'time':
+        pids, scores = time_rank()
+    elif opt_rank == 'random':
+        pids, scores = random_rank()
+    else:
+        raise ValueError("opt_rank %s is not a thing" % (opt_rank, ))
+
+    # filter by time and optionally hide papers we already have
+    if filtered:
+        corpus = get_corpus()
+        mask = np.append(mask, False) # papers that aren't in the snapshot (yet) are filtered out
+        rows = np.array([corpus['ptoi'].get(pid, -1) for pid in pids], dtype=np.int64)
+        keep = np.flatnonzero(mask[rows])
+        pids = corpus['pids'][rows[keep]]
+        scores = np.asarray(scores, dtype=np.float64)[keep]
+
+    return Ranking(pids, scores, presorted=True), []
+
 # -----------------------------------------------------------------------------
 # primary application endpoints
 
@@ -218,6 +509,8 @@ def main():
     opt_skip_have = request.args.get('skip_have', default_skip_have) # hide papers we already have?
     opt_svm_c = request.args.get('svm_c', '') # svm C parameter
     opt_page_number = request.args.get('page_number', '1') # page number for pagination
+    opt_cursor = request.args.get('cursor', '') # handle to a cached ranking, when paginating
+    opt_exact = request.args.get('exact', 'no') # train an svm for rank=pid instead of using precomputed neighbors?
 
     # if a query is given, override rank to be of type "search"
     # this allows the user to simply hit ENTER in the search field and have the correct thing happen
@@ -230,49 +523,30 @@ def main():
     except ValueError:
         C = 0.01 # sensible default, i think
 
-    # rank papers: by tags, by time, by random
-    words = [] # only populated in the case of svm rank
-    if opt_rank == 'search':
-        pids, scores = search_rank(q=opt_q)
-    elif opt_rank == 'tags':
-        pids, scores, words = svm_rank(tags=opt_tags, C=C)
-    elif opt_rank == 'pid':
-        pids, scores, words = svm_rank(pid=opt_pid, C=C)
-    elif opt_rank == 'time':
-        pids, scores = time_rank()
-    elif opt_rank == 'random':
-        pids, scores = random_rank()
-    else:
-        raise ValueError("opt_rank %s is not a thing" % (opt_rank, ))
-
-    # filter by time
-    if opt_time_filter:
-        mdb = get_metas()
-        kv = {k:v for k,v in mdb.items()} # read all of metas to memory at once, for efficiency
-        tnow = time.time()
-        deltat = int(opt_time_filter)*60*60*24 # allowed time delta in seconds
-        keep = [i for i,pid in enumerate(pids) if (tnow - kv[pid]['_time']) < deltat]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
-
-    # optionally hide papers we already have
-    if opt_skip_have == 'yes':
-        tags = get_tags()
-        have = set().union(*tags.values())
-        keep = [i for i,pid in enumerate(pids) if pid not in have]
-        pids, scores = [pids[i] for i in keep], [scores[i] for i in keep]
-
-    # crop the number of results to RET_NUM, and paginate
+    # we only ever show RET_NUM results at a time, so figure out which page we're on
     try:
         page_number = max(1, int(opt_page_number))
     except ValueError:
         page_number = 1
     start_index = (page_number - 1) * RET_NUM # desired starting index
-    end_index = min(start_index + RET_NUM, len(pids)) # desired ending index
-    pids = pids[start_index:end_index]
-    scores = scores[start_index:end_index]
+
+    if opt_rank == 'time':
+        # the default landing page: read just the one page we need off the time index
+        pids, scores = time_rank(start_index, RET_NUM, opt_time_filter, opt_skip_have == 'yes')
+        words, cursor = [], ''
+    else:
+        # rank papers, or reuse the full ranking we computed earlier for these exact settings,
+        # e.g. when the user is just paging through the results
+        key = rank_cache_key(opt_rank, opt_q, opt_tags, opt_pid, opt_time_filter, opt_skip_have, C, opt_exact)
+        entry = rank_cache_get(key, cursor=opt_cursor)
+        if entry is None:
+            ranking, words = rank_papers(opt_rank, opt_q, opt_tags, opt_pid, opt_time_filter, opt_skip_have, C, opt_exact)
+            entry = rank_cache_put(key, ranking, words)
+        pids, scores = entry['ranking'].page(start_index, start_index + RET_NUM)
+        words, cursor = entry['words'], entry['cursor']
 
     # render all papers to just the information we need for the UI
-    papers = [render_pid(pid) for pid in pids]
+    papers = render_pids(pids)
     for i, p in enumerate(papers):
         p['weight'] = float(scores[i])
 
@@ -294,9 +568,11 @@ def main():
     context['gvars']['pid'] = opt_pid
     context['gvars']['time_filter'] = opt_time_filter
     context['gvars']['skip_have'] = opt_skip_have
+    context['gvars']['exact'] = opt_exact
     context['gvars']['search_query'] = opt_q
     context['gvars']['svm_c'] = str(C)
     context['gvars']['page_number'] = str(page_number)
+    context['gvars']['cursor'] = cursor
     return render_template('index.html', **context)
 
 @app.route('/inspect', methods=['GET'])
@@ -308,12 +584,12 @@ def inspect():
     if pid not in pdb:
         return "error, malformed pid" # todo: better error handling
 
-    # load the tfidf vectors, the vocab, and the idf table
-    features = load_features()
+    # fetch the tfidf vectors, the vocab, and the idf table
+    features = get_features()
     x = features['x']
     idf = features['idf']
-    ivocab = {v:k for k,v in features['vocab'].items()}
-    pix = features['pids'].index(pid)
+    ivocab = features['ivocab']
+    pix = features['ptoi'][pid]
     wixs = np.flatnonzero(np.asarray(x[pix].todense()))
     words = []
     for ix in wixs:
@@ -343,15 +619,14 @@ def profile():
 @app.route('/stats')
 def stats():
     context = default_context()
-    mdb = get_metas()
-    kv = {k:v for k,v in mdb.items()} # read all of metas to memory at once, for efficiency
-    times = [v['_time'] for v in kv.values()]
+    corpus = get_corpus()
+    times = corpus['times'][np.isfinite(corpus['times'])]
     tstr = lambda t: time.strftime('%b %d %Y', time.localtime(t))
 
-    context['num_papers'] = len(kv)
-    if len(kv) > 0:
-        context['earliest_paper'] = tstr(min(times))
-        context['latest_paper'] = tstr(max(times))
+    context['num_papers'] = len(times)
+    if len(times) > 0:
+        context['earliest_paper'] = tstr(times.min())
+        context['latest_paper'] = tstr(times.max())
     else:
         context['earliest_paper'] = 'N/A'
         context['latest_paper'] = 'N/A'
@@ -359,7 +634,7 @@ def stats():
     # count number of papers from various time deltas to now
     tnow = time.time()
     for thr in [1, 6, 12, 24, 48, 72, 96]:
-        context['thr_%d' % thr] = len([t for t in times if t > tnow - thr*60*60])
+        context['thr_%d' % thr] = int((times > tnow - thr*60*60).sum())
 
     return render_template('stats.html', **context)
 
@@ -380,25 +655,13 @@ def add(pid=None, tag=None):
     elif tag == 'null':
         return "error, cannot add the protected tag 'null'"
 
+    # a single row insert, so concurrent clicks don't overwrite each other
     with get_tags_db(flag='c') as tags_db:
+        tags_db.add(g.user, tag, pid)
 
-        # create the user if we don't know about them yet with an empty library
-        if not g.user in tags_db:
-            tags_db[g.user] = {}
-
-        # fetch the user library object
-        d = tags_db[g.user]
-
-        # add the paper to the tag
-        if tag not in d:
-            d[tag] = set()
-        d[tag].add(pid)
-
-        # write back to database
-        tags_db[g.user] = d
-
+    rank_cache_drop_user(g.user)
     print("added paper %s to tag %s for user %s" % (pid, tag, g.user))
-    return "ok: " + str(d) # return back the user library for debugging atm
+    return "ok added pid %s to tag %s" % (pid, tag)
 
 @app.route('/sub/<pid>/<tag>')
 def sub(pid=None, tag=None):
@@ -411,27 +674,15 @@ def sub(pid=None, tag=None):
         if not g.user in tags_db:
             return "user has no library of tags ¯\_(ツ)_/¯"
 
-        # fetch the user library object
-        d = tags_db[g.user]
-
-        # add the paper to the tag
-        if tag not in d:
+        if not tags_db.has_tag(g.user, tag):
             return "user doesn't have the tag %s" % (tag, )
-        else:
-            if pid in d[tag]:
 
-                # remove this pid from the tag
-                d[tag].remove(pid)
+        # remove this pid from the tag. if it was the last paper in this tag, the tag is gone too
+        if not tags_db.remove(g.user, tag, pid):
+            return "user doesn't have paper %s in tag %s" % (pid, tag)
 
-                # if this was the last paper in this tag, also delete the tag
-                if len(d[tag]) == 0:
-                    del d[tag]
-
-                # write back the resulting dict to database
-                tags_db[g.user] = d
-                return "ok removed pid %s from tag %s" % (pid, tag)
-            else:
-                return "user doesn't have paper %s in tag %s" % (pid, tag)
+    rank_cache_drop_user(g.user)
+    return "ok removed pid %s from tag %s" % (pid, tag)
 
 @app.route('/del/<tag>')
 def delete_tag(tag=None):
@@ -443,19 +694,13 @@ def delete_tag(tag=None):
         if g.user not in tags_db:
             return "user does not have a library"
 
-        d = tags_db[g.user]
-
-        if tag not in d:
-            return "user does not have this tag"
-
         # delete the tag
-        del d[tag]
-
-        # write back to database
-        tags_db[g.user] = d
+        if tags_db.delete_tag(g.user, tag) == 0:
+            return "user does not have this tag"
 
+    rank_cache_drop_user(g.user)
     print("deleted tag %s for user %s" % (tag, g.user))
-    return "ok: " + str(d) # return back the user library for debugging atm
+    return "ok deleted tag %s" % (tag, )
 
 # -----------------------------------------------------------------------------
 # endpoints to log in and out
@@ -2,103 +2,245 @@
 Iterates over the current database and makes best effort to download the papers,
 convert them to thumbnail images and save them to disk, for display in the UI.
 Atm only runs the most recent 5K papers. Intended to be run as a cron job daily
-or something like that.
+or something like that. The thumbnails we have are tracked in a manifest (data/thumbs.p),
+delete it to have it rebuilt from the thumb directory. Papers that we fail to make a
+thumbnail for are retried with exponential backoff, and given up on after a few attempts.
+
+This runs as a little pipeline: a few fetcher threads download the pdfs, politely
+spaced out in time across all of them, and a pool of render workers turns them into
+thumbnails with imagemagick, each in its own temporary directory. The rendering is
+done by the convert/montage subprocesses, so threads are enough to keep all cores busy.
 """
 
 import os
+import glob
 import time
+import queue
 import random
+import shutil
+import signal
+import argparse
+import threading
+import subprocess
+
 import requests
-from subprocess import Popen
+
 from aslite.db import get_papers_db, get_metas_db
+from aslite.db import load_thumbs, save_thumbs, THUMB_DIR
+from aslite.db import get_thumb_failures_db
 
-# create the tmp directory if it does not exist, where we will do temporary work
+# where we will do temporary work
 TMP_DIR = 'tmp'
-if not os.path.exists(TMP_DIR):
-    os.makedirs(TMP_DIR)
-# create the thumb directory, where we will store the paper thumbnails
-THUMB_DIR = os.path.join('static', 'thumb')
-if not os.path.exists(THUMB_DIR):
-    os.makedirs(THUMB_DIR)
-
-# open the database, determine which papers we'll try to get thumbs for
-pdb = get_papers_db()
-n = len(pdb)
-mdb = get_metas_db()
-metas = list(mdb.items())
-metas.sort(key=lambda kv: kv[1]['_time'], reverse=True) # most recent papers first
-keys = [k for k,v in metas[:5000]] # only the most recent papers
-
-for i, key in enumerate(keys):
-    time.sleep(0.01) # for safety
-
-    # the path where we would store the thumbnail for this key
-    thumb_path = os.path.join(THUMB_DIR, key + '.jpg')
-    if os.path.exists(thumb_path):
-        continue
-
-    # fetch the paper
-    p = pdb[key]
-    print("%d/%d: paper to process: %s" % (i, n, key))
-
-    # get the link to the pdf
-    url = p['link'].replace('abs', 'pdf')
-
-    # attempt to download the pdf
+
+# -----------------------------------------------------------------------------
+
+class RateLimiter:
+    """ spaces out the calls to wait(), across all threads, by interval + U(0, jitter) seconds """
+
+    def __init__(self, interval, jitter, stop):
+        self.interval = interval
+        self.jitter = jitter
+        self.stop = stop
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            t = max(now, self.next_time)
+            self.next_time = t + self.interval + random.uniform(0, self.jitter)
+        self.stop.wait(t - now) # returns early if we are shutting down
+
+def fetch_pdf(url, pdf_path, timeout):
+    """ downloads the pdf at url to pdf_path, returns True on success """
     print("attempting to download pdf from: ", url)
     try:
-        x = requests.get(url, timeout=10, allow_redirects=True)
-        with open(os.path.join(TMP_DIR, 'paper.pdf'), 'wb') as f:
+        x = requests.get(url, timeout=timeout, allow_redirects=True)
+        x.raise_for_status() # e.g. arxiv rate limiting us, don't save the error page as the pdf
+        if not x.content.startswith(b'%PDF'):
+            raise ValueError('not a pdf (content type %s)' % (x.headers.get('Content-Type'), ))
+        with open(pdf_path, 'wb') as f:
             f.write(x.content)
-        print("OK")
+        return True
     except Exception as e:
         print("error downloading the pdf at url", url)
         print(e)
-        continue
-    time.sleep(5 + random.uniform(0, 5)) # take a breather
-
-    # mv away the previous temporary files if they exist
-    if os.path.isfile(os.path.join(TMP_DIR, 'thumb-0.png')):
-        for i in range(8):
-            f1 = os.path.join(TMP_DIR, 'thumb-%d.png' % (i,))
-            f2 = os.path.join(TMP_DIR, 'thumbbuf-%d.png' % (i,))
-            if os.path.isfile(f1):
-                cmd = 'mv %s %s' % (f1, f2)
-                os.system(cmd)
-
-    # convert pdf to png images per page. spawn async because convert can unfortunately enter an infinite loop, have to handle this.
-    # this command will generate 8 independent images thumb-0.png ... thumb-7.png of the thumbnails
-    print("converting the pdf to png images")
-    pp = Popen(['convert', '%s[0-7]' % ('tmp/paper.pdf', ), '-thumbnail', 'x156', os.path.join(TMP_DIR, 'thumb.png')])
-    t0 = time.time()
-    while time.time() - t0 < 20: # give it 20 seconds deadline
-        ret = pp.poll()
-        if not (ret is None):
-            # process terminated
-            break
-        time.sleep(0.1)
-    ret = pp.poll()
-    if ret is None:
-        print("convert command did not terminate in 20 seconds, terminating.")
-        pp.terminate() # give up
-        continue
-
-    if not os.path.isfile(os.path.join(TMP_DIR, 'thumb-0.png')):
-        # failed to render pdf, replace with missing image
-        #missing_thumb_path = os.path.join('static', 'missing.jpg')
-        #os.system('cp %s %s' % (missing_thumb_path, thumb_path))
-        #print("could not render pdf, creating a missing image placeholder")
+        return False
+
+def run_with_timeout(cmd, timeout):
+    """ runs cmd, and kills it along with any of its children (e.g. the ghostscript that convert runs) after timeout seconds """
+    p = subprocess.Popen(cmd, start_new_session=True)
+    try:
+        return p.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(p.pid, signal.SIGKILL)
+        p.wait()
+        raise
+
+def render_thumb(pdf_path, thumb_path, workdir, timeout):
+    """ renders the first 8 pages of the pdf into a single strip of thumbnails, returns None on success or the reason it failed """
+    # convert pdf to png images per page, this will generate 8 independent images thumb-0.png ... thumb-7.png.
+    # convert can unfortunately enter an infinite loop, so it gets a deadline
+    try:
+        run_with_timeout(['convert', '%s[0-7]' % (pdf_path, ), '-thumbnail', 'x156', os.path.join(workdir, 'thumb.png')], timeout)
+    except subprocess.TimeoutExpired:
+        print("convert command did not terminate in %d seconds, terminating." % (timeout, ))
+        return 'convert timeout'
+
+    pngs = glob.glob(os.path.join(workdir, 'thumb-*.png'))
+    if not pngs:
+        # failed to render pdf
         print("could not render pdf, skipping")
-        continue
-    else:
-        # otherwise concatenate the 8 images into one
-        cmd = "montage -mode concatenate -quality 80 -tile x1 %s %s" \
-              % (os.path.join(TMP_DIR, 'thumb-*.png'), thumb_path)
-        print(cmd)
-        os.system(cmd)
-
-    # remove the temporary paper.pdf file
-    tmp_pdf = os.path.join(TMP_DIR, 'paper.pdf')
-    if os.path.isfile(tmp_pdf):
-        os.remove(tmp_pdf)
+        return 'convert failed'
+
+    # otherwise concatenate the (up to) 8 images into one
+    pngs.sort(key=lambda f: int(f[f.rindex('-')+1:-4]))
+    try:
+        run_with_timeout(['montage', '-mode', 'concatenate', '-quality', '80', '-tile', 'x1'] + pngs + [thumb_path], timeout)
+    except subprocess.TimeoutExpired:
+        print("montage command did not terminate in %d seconds, terminating." % (timeout, ))
+        return 'montage timeout'
+    return None if os.path.isfile(thumb_path) else 'montage failed'
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Thumbnail Daemon')
+    parser.add_argument('-n', '--num', type=int, default=5000, help='make thumbnails for up to this many of the most recent papers')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='number of render workers')
+    parser.add_argument('-f', '--fetchers', type=int, default=2, help='number of download threads')
+    parser.add_argument('--delay', type=float, default=5.0, help='minimum seconds between two pdf downloads, across all fetchers')
+    parser.add_argument('--jitter', type=float, default=5.0, help='random extra seconds of delay between two pdf downloads')
+    parser.add_argument('--timeout', type=int, default=20, help='seconds before we give up on a download or an imagemagick command')
+    parser.add_argument('--retry_days', type=float, default=1.0, help='days to wait before retrying a failed paper, doubling after every failure')
+    parser.add_argument('--max_attempts', type=int, default=4, help='give up on a paper for good after this many failures')
+    args = parser.parse_args()
+    print(args)
+
+    # create the directories for the temporary work and for the paper thumbnails
+    os.makedirs(TMP_DIR, exist_ok=True)
+    os.makedirs(THUMB_DIR, exist_ok=True)
+
+    # the thumbnails we already have, pid -> (size, mtime)
+    thumbs = load_thumbs()
+    save_thumbs(thumbs) # in case it was just built by a scan
+    thumbs_lock = threading.Lock()
+
+    # open the database, determine which papers we'll try to get thumbs for
+    pdb = get_papers_db()
+    mdb = get_metas_db()
+    keys = [k for k,t in mdb.latest(limit=args.num)] # only the most recent papers, most recent first
+    todo = [k for k in keys if k not in thumbs]
+
+    # skip the papers that failed recently, or too many times
+    fdb = get_thumb_failures_db(flag='c')
+    failures = {k:v for k,v in fdb.items()}
+    tnow = time.time()
+    def should_try(key):
+        f = failures.get(key)
+        return f is None or (f['next_retry'] is not None and f['next_retry'] <= tnow)
+    nall = len(todo)
+    todo = [k for k in todo if should_try(k)]
+    print("%d of the %d most recent papers need a thumbnail, skipping %d that failed before" % (nall, len(keys), nall - len(todo)))
+
+    def record_failure(key, reason):
+        # note: only the thread that handles this key ever touches its entry. only the rendering
+        # failures get recorded, i.e. the papers whose pdf we have but that don't render
+        f = failures.get(key, {'attempts': 0})
+        attempts = f['attempts'] + 1
+        if attempts >= args.max_attempts:
+            next_retry = None # placeholder that we never try this paper again
+            print("giving up on %s after %d attempts, last failure: %s" % (key, attempts, reason))
+        else:
+            next_retry = time.time() + args.retry_days * 60*60*24 * 2**(attempts - 1)
+        failures[key] = {'reason': reason, 'attempts': attempts, 'last_time': time.time(), 'next_retry': next_retry}
+        fdb[key] = failures[key]
+
+    stop = threading.Event() # set on ctrl-c, everyone finishes what they are doing and exits
+    limiter = RateLimiter(args.delay, args.jitter, stop)
+    fetch_q = queue.Queue()
+    render_q = queue.Queue(maxsize=2 * args.workers) # bounded, so we don't download way ahead of rendering
+
+    def fetcher(i):
+        workdir = os.path.join(TMP_DIR, 'fetch-%d' % (i, ))
+        os.makedirs(workdir, exist_ok=True)
+        while not stop.is_set():
+            job = fetch_q.get()
+            if job is None:
+                break
+            key, url = job
+            limiter.wait()
+            if stop.is_set():
+                break
+            pdf_path = os.path.join(workdir, key + '.pdf')
+            # a failed download is most likely on the side of the network or of arxiv, not of the
+            # paper, so it doesn't count towards giving up on the paper. we just try again next time
+            if fetch_pdf(url, pdf_path, args.timeout):
+                render_q.put((key, pdf_path))
+
+    def renderer(i):
+        workdir = os.path.join(TMP_DIR, 'render-%d' % (i, ))
+        while True:
+            job = render_q.get()
+            if job is None:
+                break
+            key, pdf_path = job
+            if not stop.is_set():
+                # start from a clean workspace, so we never pick up the pages of an earlier paper
+                shutil.rmtree(workdir, ignore_errors=True)
+                os.makedirs(workdir)
+                thumb_path = os.path.join(THUMB_DIR, key + '.jpg')
+                print("rendering the thumbnail of %s" % (key, ))
+                reason = render_thumb(pdf_path, thumb_path, workdir, args.timeout)
+                if reason is None:
+                    # add it to the manifest, so the server picks it up
+                    st = os.stat(thumb_path)
+                    with thumbs_lock:
+                        thumbs[key] = (st.st_size, st.st_mtime)
+                        save_thumbs(thumbs)
+                    if key in failures:
+                        del fdb[key] # it worked out in the end
+                else:
+                    record_failure(key, reason)
+            os.remove(pdf_path)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    fetchers = [threading.Thread(target=fetcher, args=(i, )) for i in range(args.fetchers)]
+    renderers = [threading.Thread(target=renderer, args=(i, )) for i in range(args.workers)]
+    for t in fetchers + renderers:
+        t.start()
+
+    try:
+        for i, key in enumerate(todo):
+            print("%d/%d: paper to process: %s" % (i, len(todo), key))
+            url = pdb[key]['link'].replace('abs', 'pdf')
+            fetch_q.put((key, url))
+        for _ in fetchers:
+            fetch_q.put(None)
+        # note: join with a timeout so that ctrl-c still gets through to us
+        while any(t.is_alive() for t in fetchers):
+            for t in fetchers:
+                t.join(0.5)
+    except KeyboardInterrupt:
+        print("interrupted, waiting for the workers to finish up...")
+        stop.set()
+        while True: # unblock any fetchers that are still waiting for jobs
+            try:
+                fetch_q.get_nowait()
+            except queue.Empty:
+                break
+        for _ in fetchers:
+            fetch_q.put(None)
+        for t in fetchers:
+            t.join()
 
+    # all the downloads are done, let the renderers drain their queue and exit
+    for _ in renderers:
+        render_q.put(None)
+    for t in renderers:
+        t.join()
+    for i in range(args.fetchers):
+        shutil.rmtree(os.path.join(TMP_DIR, 'fetch-%d' % (i, )), ignore_errors=True)
+    fdb.close()
+    print("done, have %d thumbnails" % (len(thumbs), ))